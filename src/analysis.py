@@ -0,0 +1,107 @@
+"""
+Quick ffmpeg analysis passes run before a conversion.
+"""
+import json
+import math
+import re
+from collections import Counter
+from subprocess import run, PIPE, CalledProcessError
+
+
+def ffmpeg_stderr(command):
+    p = run(command, stdout=PIPE, stderr=PIPE)
+    if p.returncode:
+        raise CalledProcessError(p.returncode, command)
+    return p.stderr.decode('UTF-8', errors='replace')
+
+
+def measure_loudness(input_path, audio_streams, target):
+    """
+    Runs a single audio only pass with one loudnorm per audio stream and returns the measured values of
+    every stream, None for a stream that is silent or whose measure can not be read.
+    """
+    integrated, true_peak, loudness_range = target
+    audio_streams = list(audio_streams)
+    if not audio_streams:
+        return []
+    graph = ';'.join(f'[0:a:{stream}]loudnorm=I={integrated}:TP={true_peak}:LRA={loudness_range}:'
+                     f'print_format=json[loudness{position}]' for position, stream in enumerate(audio_streams))
+    maps = [arg for position in range(len(audio_streams)) for arg in ('-map', f'[loudness{position}]')]
+    try:
+        stderr = ffmpeg_stderr(['ffmpeg', '-hide_banner', '-nostats', '-i', input_path,
+                                '-filter_complex', graph, *maps, '-f', 'null', '-'])
+    except CalledProcessError:
+        return [None] * len(audio_streams)
+
+    # Each loudnorm prints its measure under its own name, numbered in the order of the graph
+    measures = [None] * len(audio_streams)
+    for position, block in re.findall(r'\[Parsed_loudnorm_(\d+) @ [^\]]*\]\s*(\{.*?\})', stderr, re.DOTALL):
+        try:
+            measured = json.loads(block)
+            if math.isfinite(float(measured['input_i'])):
+                measures[int(position)] = measured
+        except (IndexError, KeyError, ValueError):
+            continue
+    return measures
+
+
+def loudnorm_filter(measured, target):
+    integrated, true_peak, loudness_range = target
+    return f'loudnorm=I={integrated}:TP={true_peak}:LRA={loudness_range}:' \
+           f'measured_I={measured["input_i"]}:measured_TP={measured["input_tp"]}:' \
+           f'measured_LRA={measured["input_lra"]}:measured_thresh={measured["input_thresh"]}:' \
+           f'offset={measured["target_offset"]}:linear=true'
+
+
+def sample_starts(duration, count, length):
+    """
+    Start times (seconds) of count samples of length seconds spread over the middle 80% of duration.
+    """
+    span = max(duration * 0.8 - length, 0)
+    return [duration * 0.1 + span * (i + 0.5) / count for i in range(count)]
+
+
+def detect_crop(input_path, starts, length, frame_size, agreement, min_size):
+    """
+    Runs cropdetect on the main video for length seconds at every start and votes on the crop found by
+    each sample. Returns the winning crop as w:h:x:y, None if it is not shared by at least agreement of the
+    samples or removes less than min_size pixels in both directions.
+    """
+    width, height = frame_size
+    votes = Counter()
+    for start in starts:
+        try:
+            stderr = ffmpeg_stderr(['ffmpeg', '-hide_banner', '-nostats', '-ss', f'{start:.3f}', '-i', input_path,
+                                    '-t', str(length), '-map', '0:v:0', '-vf', 'cropdetect=limit=24:round=2:reset=0',
+                                    '-an', '-sn', '-dn', '-f', 'null', '-'])
+        except CalledProcessError:
+            continue
+        crops = re.findall(r'crop=(\d+:\d+:\d+:\d+)', stderr)
+        if crops:
+            votes[crops[-1]] += 1
+
+    if not votes:
+        return None
+    crop, count = votes.most_common(1)[0]
+    crop_width, crop_height = map(int, crop.split(':')[:2])
+    if count < agreement * len(starts) or \
+            (width - crop_width < min_size and height - crop_height < min_size):
+        return None
+    return crop
+
+
+def ssim(distorted, reference, crop=None):
+    """
+    Average SSIM of the video of distorted against reference, the reference being cropped like the distorted
+    one was and scaled to its size.
+    """
+    crop_filter = f'crop={crop},' if crop else ''
+    stderr = ffmpeg_stderr(['ffmpeg', '-hide_banner', '-nostats', '-i', distorted, '-i', reference,
+                            '-lavfi', f'[1:v]{crop_filter}null[cropped];'
+                                      f'[cropped][0:v]scale2ref=flags=bicubic[reference][distorted];'
+                                      f'[distorted][reference]ssim',
+                            '-f', 'null', '-'])
+    scores = re.findall(r'All:([\d.]+)', stderr)
+    if not scores:
+        raise ValueError('No SSIM in ffmpeg output')
+    return float(scores[-1])
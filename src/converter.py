@@ -1,10 +1,22 @@
+import itertools
 import os
 import shlex
+import shutil
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
-from subprocess import check_call, CalledProcessError
+from queue import PriorityQueue, Full
+from subprocess import call, check_call, check_output, CalledProcessError, Popen, PIPE
 
-from modules import get_pending_items, scp_option
+from analysis import detect_crop, measure_loudness, loudnorm_filter, sample_starts, ssim
+from modules import PlexClient, PlexRefresher, get_pending_items, handled_index, target, watcher
+from transfer import make_transfer
+
+
+NEXT_STAGE = {'convert': 'normalize', 'normalize': 'upload', 'upload': None}
+TEXT_SUBTITLES = {'subrip', 'srt', 'ass', 'ssa', 'mov_text', 'webvtt', 'text'}
+IMAGE_SUBTITLES = {'hdmv_pgs_subtitle', 'dvd_subtitle', 'dvb_subtitle', 'xsub'}
 
 
 class PlexConverter:
@@ -27,136 +39,445 @@ class PlexConverter:
             os.mkdir(self.OUTPUT_FOLDER)
 
         self.ssh = f'{config["SSH"]["USER"]}@{config["PLEX"]["URL"]}'
+        self.transfer = make_transfer(config['TRANSFER'], self.ssh)
+        self.refresher = None
+        if config['PLEX'].getboolean('PARTIAL_REFRESH'):
+            plex = PlexClient(f'http://{config["PLEX"]["URL"]}:{config["PLEX"]["PORT"]}', config['PLEX']['TOKEN'],
+                              timeout=(config['PLEX'].getfloat('CONNECT_TIMEOUT'),
+                                       config['PLEX'].getfloat('READ_TIMEOUT')),
+                              retries=config['PLEX'].getint('RETRIES'), pool_size=1)
+            self.refresher = PlexRefresher(plex, config['PLEX'].getint('REFRESH_DELAY'))
 
         self.max_video_width = config['CONVERTER'].getint('MAX_VIDEO_WIDTH')
         self.avg_bitrate = config['CONVERTER'].getint('AVERAGE_BITRATE')
         self.max_bitrate = config['CONVERTER'].getint('MAX_BITRATE')
-
-    def convert(self, item):
-        print(f'--- Converting ---')
+        self.image_subtitles = config['CONVERTER']['IMAGE_SUBTITLES']
+
+        self.quality_search = config['CONVERTER'].getboolean('QUALITY_SEARCH')
+        self.quality_floor = config['CONVERTER'].getfloat('SSIM_FLOOR')
+        self.quality_bitrates = sorted({min(int(bitrate), self.max_bitrate) for bitrate in
+                                        config['CONVERTER']['QUALITY_BITRATES'].split(',')})
+        self.quality_samples = config['CONVERTER'].getint('QUALITY_SAMPLES')
+        self.sample_length = config['CONVERTER'].getint('SAMPLE_LENGTH')
+
+        self.crop_detect = config['CONVERTER'].getboolean('CROP_DETECT')
+        self.crop_samples = config['CONVERTER'].getint('CROP_SAMPLES')
+        self.crop_agreement = config['CONVERTER'].getfloat('CROP_AGREEMENT')
+        self.crop_min_size = config['CONVERTER'].getint('CROP_MIN_SIZE')
+
+        self.chunk_min_duration = config['CONVERTER'].getint('CHUNK_MIN_DURATION')
+        self.chunk_length = config['CONVERTER'].getint('CHUNK_LENGTH')
+        self.chunk_jobs = config['CONVERTER'].getint('CHUNK_JOBS')
+
+        self.normalize_in_convert = config['CONVERTER'].getboolean('NORMALIZE_IN_CONVERT')
+        self.loudness_target = (config['CONVERTER'].getfloat('LOUDNESS_TARGET'),
+                                config['CONVERTER'].getfloat('TRUE_PEAK'),
+                                config['CONVERTER'].getfloat('LOUDNESS_RANGE'))
+        self.stream_upload = config['CONVERTER'].getboolean('STREAM_UPLOAD')
+        if self.stream_upload and not self.normalize_in_convert:
+            print('STREAM_UPLOAD requires NORMALIZE_IN_CONVERT, uploading finished files instead')
+            self.stream_upload = False
+        self.next_stage = dict(NEXT_STAGE)
+        if self.normalize_in_convert:
+            self.next_stage['convert'] = None if self.stream_upload else 'upload'
+
+        self.stage_folders = {'upload': self.OUTPUT_FOLDER,
+                              'normalize': self.NORMALIZING_FOLDER,
+                              'convert': self.CONVERTING_FOLDER}
+        self.threads_per_job = config['CONVERTER'].getint('THREADS_PER_JOB')
+        self.pin_cpus = config['CONVERTER'].getboolean('PIN_CPUS') and shutil.which('taskset') is not None
+        encode_jobs = config['CONVERTER'].getint('ENCODE_JOBS') or \
+            max(1, (os.cpu_count() or 1) // self.threads_per_job)
+
+        self.stage_workers = {'convert': encode_jobs,
+                              'normalize': config['CONVERTER'].getint('NORMALIZE_WORKERS'),
+                              'upload': config['CONVERTER'].getint('UPLOAD_WORKERS')}
+        queue_size = config['CONVERTER'].getint('QUEUE_SIZE')
+        self.queues = {stage: PriorityQueue(queue_size) for stage in NEXT_STAGE}
+        self.in_flight = set()
+        self.lock = threading.Lock()
+        self.order = itertools.count()
+
+    def job_cpus(self, job):
+        cpu_count = os.cpu_count() or 1
+        return {cpu % cpu_count for cpu in range(job * self.threads_per_job, (job + 1) * self.threads_per_job)}
+
+    def convert(self, item, job=0):
+        print(f'--- Converting (job {job}) ---')
+        if item.remote_path is not None:
+            handled_index.set_state(item.remote_path, 'converting')
         input_path = os.path.join(self.CONVERTING_FOLDER, item.local_file)
         output_path = os.path.join(self.TEMP_FOLDER, item.local_file.rsplit('.', 1)[0] + '.mkv')
-
-        nvenc = 'CUDA' in os.environ['PATH']
-        video_options = '-c:v h264_nvenc -preset slow -rc:v vbr_hq -cq:v 19' if nvenc \
-            else '-c:v libx264 -preset slow'
-        try:
-            audio_channels = min(int(item.audio_channels), 2)
-        except ValueError:
-            audio_channels = 2
-
-        if item.need_video_convert():
-            command = f'ffmpeg -v warning -stats -fflags +genpts -i "{input_path}" -movflags fastart -map 0 ' \
-                      f'-pix_fmt yuv420p -vf scale={self.max_video_width}:-2:flags=lanczos ' \
-                      f'{video_options} -profile:v high -level:v 4.1 -qmin 16 ' \
-                      f'-b:v {self.avg_bitrate}k -maxrate:v {self.max_bitrate}k -bufsize {2 * self.avg_bitrate}k ' \
-                      f'-c:a {f"aac -ac {audio_channels}" if item.need_audio_convert() else "copy"} ' \
-                      f'-c:s srt "{output_path}"'
-
-        elif item.need_audio_convert():
-            command = f'ffmpeg -v warning -stats -fflags +genpts -i "{input_path}" -movflags fastart -map 0 ' \
-                      f'-c:v copy -c:a aac -ac {audio_channels} -c:s srt "{output_path}"'
-
+        streaming = self.stream_upload and item.remote_path is not None
+        output = '-f matroska -' if streaming else f'"{output_path}"'
+
+        # Commands of the job run under taskset, an affinity set in the forked child is unsafe with threads
+        pin = ['taskset', '-c', ','.join(map(str, sorted(self.job_cpus(job))))] if self.pin_cpus else []
+        chunk_folder = os.path.join(self.TEMP_FOLDER, f'{item.name}.chunks')
+
+        crop = None
+        if self.crop_detect and item.need_video_convert():
+            crop = self.detect_crop(item, input_path)
+        bitrate = self.avg_bitrate
+        if self.quality_search and item.need_video_convert():
+            bitrate = self.search_bitrate(item, input_path, chunk_folder, pin, crop)
+        max_framerate = item.plan.max_framerate if item.plan else None
+        video_encode = self.video_encode(bitrate, crop, max_framerate)
+
+        chunked = item.need_video_convert() and self.chunk_min_duration and \
+            item.duration > self.chunk_min_duration * 60000
+        if chunked:
+            stream_options = self.stream_options(item, input_path, None, source=1, video_source=0)
         else:
-            command = f'ffmpeg -v warning -stats -fflags +genpts -i "{input_path}" -movflags fastart -map 0 ' \
-                      f'-c:v copy -c:a copy -c:s srt "{output_path}"'
+            stream_options = self.stream_options(item, input_path,
+                                                 video_encode if item.need_video_convert() else None)
+        command = f'ffmpeg -v warning -stats -fflags +genpts -i "{input_path}" -threads {self.threads_per_job} ' \
+                  f'-movflags fastart {stream_options} {output}'
+        start = time.time()
 
         try:
-            print(command)
-            check_call(shlex.split(command))
-            item.local_file = os.path.basename(output_path)
-            os.rename(output_path,
-                      os.path.join(self.NORMALIZING_FOLDER, item.local_file))
-            os.remove(input_path)
+            if chunked:
+                concat_list = self.encode_chunks(input_path, chunk_folder, (bitrate, crop, max_framerate), pin)
+                command = f'ffmpeg -v warning -stats -f concat -safe 0 -i "{concat_list}" ' \
+                          f'-fflags +genpts -i "{input_path}" -threads {self.threads_per_job} ' \
+                          f'-movflags fastart {stream_options} {output}'
 
-        except CalledProcessError:
-            print('Conversion failed !')
-            time.sleep(30)
-            self.convert(item)
+            print(command)
+            if streaming:
+                size = self.upload_stream(item, command, os.path.basename(output_path), pin)
+                item.local_file = os.path.basename(output_path)
+            else:
+                check_call(pin + shlex.split(command))
+                item.local_file = os.path.basename(output_path)
+                os.rename(output_path,
+                          os.path.join(self.OUTPUT_FOLDER if self.normalize_in_convert else self.NORMALIZING_FOLDER,
+                                       item.local_file))
+
+            if item.need_video_convert():
+                handled_index.add_encode(item.duration / 1000, time.time() - start, self.stage_workers['convert'])
+            if item.remote_path is not None:
+                handled_index.set_state(item.remote_path, 'converted')
+
+        finally:
+            shutil.rmtree(chunk_folder, ignore_errors=True)
+
+        # The source is only removed once the streamed file replaced the original on the server
+        if streaming:
+            self.finish_stream_upload(item, size)
+        os.remove(input_path)
+
+    def video_filter(self, crop=None, max_framerate=None):
+        """
+        Crops, scales down to MAX_VIDEO_WIDTH (never up) and caps the frame rate.
+        """
+        filters = [f'crop={crop}'] if crop else []
+        filters.append(f"scale='min({self.max_video_width},iw)':-2:flags=lanczos")
+        if max_framerate:
+            filters.append(f'fps={max_framerate}')
+        return ','.join(filters)
+
+    def video_encode(self, bitrate, crop=None, max_framerate=None, threads=None):
+        nvenc = 'CUDA' in os.environ['PATH']
+        video_options = '-c:v:0 h264_nvenc -preset slow -rc:v:0 vbr_hq -cq:v:0 19' if nvenc \
+            else f'-c:v:0 libx264 -preset slow -x264-params threads={threads or self.threads_per_job}'
+        return f'-pix_fmt:v:0 yuv420p -filter:v:0 "{self.video_filter(crop, max_framerate)}" ' \
+               f'{video_options} -profile:v:0 high -level:v:0 4.1 -qmin 16 -b:v:0 {bitrate}k ' \
+               f'-maxrate:v:0 {self.max_bitrate}k -bufsize:v:0 {2 * bitrate}k'
+
+    def detect_crop(self, item, input_path):
+        frame_size = (item.main_video.width, item.main_video.height)
+        if None in frame_size:
+            return None
+        crop = detect_crop(input_path, sample_starts(item.duration / 1000, self.crop_samples, 2), 2, frame_size,
+                           self.crop_agreement, self.crop_min_size)
+        print(f'Cropping to {crop}' if crop else 'No stable crop found')
+        return crop
+
+    def search_bitrate(self, item, input_path, sample_folder, pin, crop=None):
+        """
+        Encodes a few samples of the main video at candidate bitrates and returns the lowest one whose
+        average SSIM against the source meets the floor, the highest candidate if none does.
+        Candidates are bisected, the quality growing with the bitrate. The decision is kept in the index
+        so that a retried conversion does not search again.
+        """
+        key = item.remote_path or item.name
+        bitrate = handled_index.bitrate(key)
+        if bitrate is not None:
+            return bitrate
+        duration = item.duration / 1000
+        if duration < 2 * self.quality_samples * self.sample_length:
+            return self.avg_bitrate
+
+        print(f'Searching bitrate ({len(self.quality_bitrates)} candidates, SSIM floor {self.quality_floor})')
+        shutil.rmtree(sample_folder, ignore_errors=True)
+        os.mkdir(sample_folder)
+        try:
+            samples = []
+            for i, sample_start in enumerate(sample_starts(duration, self.quality_samples, self.sample_length)):
+                sample = os.path.join(sample_folder, f'sample{i}.mkv')
+                check_call(['ffmpeg', '-v', 'error', '-ss', f'{sample_start:.3f}', '-i', input_path,
+                            '-t', str(self.sample_length), '-map', '0:v:0', '-c', 'copy', sample])
+                samples.append(sample)
+
+            low, high = 0, len(self.quality_bitrates) - 1
+            best, best_score = self.quality_bitrates[-1], None
+            while low <= high:
+                middle = (low + high) // 2
+                scores = []
+                for i, sample in enumerate(samples):
+                    encoded = os.path.join(sample_folder, f'encoded{self.quality_bitrates[middle]}_{i}.mkv')
+                    check_call(pin + shlex.split(f'ffmpeg -v error -i "{sample}" -threads {self.threads_per_job} '
+                                                 f'-map 0:v:0 '
+                                                 f'{self.video_encode(self.quality_bitrates[middle], crop)} '
+                                                 f'"{encoded}"'))
+                    scores.append(ssim(encoded, sample, crop))
+                score = sum(scores) / len(scores)
+                print(f'{self.quality_bitrates[middle]}k: SSIM {score:.4f}')
+                if score >= self.quality_floor:
+                    best, best_score = self.quality_bitrates[middle], score
+                    high = middle - 1
+                else:
+                    low = middle + 1
+        except (CalledProcessError, ValueError) as e:
+            print(f'Bitrate search failed ({e}), using {self.avg_bitrate}k')
+            return self.avg_bitrate
+        finally:
+            shutil.rmtree(sample_folder, ignore_errors=True)
+
+        print(f'Encoding at {best}k')
+        handled_index.add_bitrate(key, best, best_score)
+        return best
+
+    def upload_stream(self, item, command, output_file, pin):
+        """
+        Pipes the ffmpeg output to a partial file on the Plex server, renamed once both ends succeeded.
+        """
+        remote_dir = os.path.dirname(item.remote_path)
+        remote_path = os.path.join(remote_dir, output_file)
+        part_path = f'{remote_path}.part'
+        print(f'--- Streaming upload ---\nTo {remote_dir}')
+
+        ffmpeg = Popen(pin + shlex.split(command), stdout=PIPE)
+        ssh = Popen(['ssh', self.ssh, f'mkdir -p {shlex.quote(remote_dir)} && cat > {shlex.quote(part_path)}'],
+                    stdin=ffmpeg.stdout)
+        ffmpeg.stdout.close()
+        ssh.wait()
+        ffmpeg.wait()
+
+        if ffmpeg.returncode or ssh.returncode:
+            call(['ssh', self.ssh, 'rm', '-f', shlex.quote(part_path)])
+            raise CalledProcessError(ffmpeg.returncode or ssh.returncode, command)
+        size = int(check_output(['ssh', self.ssh, 'wc', '-c', '<', shlex.quote(part_path)]))
+        check_call(['ssh', self.ssh, 'mv', '-f', shlex.quote(part_path), shlex.quote(remote_path)])
+        return size
+
+    def finish_stream_upload(self, item, size):
+        """
+        Runs uploaded for a streamed file, retried on its own so that a failure does not encode the item again.
+        """
+        for attempt in range(self.transfer.attempts):
+            if attempt:
+                time.sleep(self.transfer.retry_delay)
+            try:
+                self.uploaded(item, size)
+                return
+            except (CalledProcessError, OSError) as e:
+                print(f'Finishing the upload of {item.local_file} failed ({e}), retry soon...')
+        raise IOError(f'Could not finish the upload of {item.local_file} in {self.transfer.attempts} attempts')
+
+    def stream_options(self, item, input_path, video_encode, source=0, video_source=None):
+        """
+        Maps the streams kept in the output and picks the codec of each one by its output index.
+        The main video comes first, encoded with video_encode or copied (from video_source when it was
+        encoded apart), audio tracks are converted only when they fail the target profile, text subtitles are
+        converted to srt, image subtitles follow IMAGE_SUBTITLES and attachments are copied.
+        Other streams are dropped.
+        """
+        if video_source is None:
+            maps = [f'-map {source}:{item.main_video.index}']
+        else:
+            maps = [f'-map {video_source}:v:0']
+        options = [video_encode or '-c:v:0 copy']
+
+        loudness = {}
+        if self.normalize_in_convert:
+            print('Measuring loudness')
+            audio_streams = [stream for stream in item.streams if stream.is_audio()]
+            loudness = dict(zip(audio_streams, measure_loudness(input_path, range(len(audio_streams)),
+                                                                self.loudness_target)))
+        for stream in item.streams:
+            output = len(maps)
+            if stream is item.main_video:
+                continue
+            elif stream.is_video() or stream.is_attachment():
+                option = f'-c:{output} copy'
+            elif stream.is_audio():
+                option = self.audio_options(stream, output, loudness.get(stream))
+            elif stream.is_subtitle() and stream.codec_name == 'subrip':
+                option = f'-c:{output} copy'
+            elif stream.is_subtitle() and stream.codec_name in TEXT_SUBTITLES:
+                option = f'-c:{output} srt'
+            elif stream.is_subtitle() and stream.codec_name in IMAGE_SUBTITLES and self.image_subtitles == 'copy':
+                option = f'-c:{output} copy'
+            else:
+                print(f'Dropping stream #{stream.index} ({stream.codec_type} {stream.codec_name})')
+                continue
+            maps.append(f'-map {source}:{stream.index}')
+            options.append(option)
+
+        return f'{" ".join(maps)} {" ".join(options)}'
+
+    def audio_options(self, stream, output, measured=None):
+        compliant = target.audio_compliant(stream.codec_name, stream.profile, stream.channels)
+        downmix = f' -ac:{output} {target.max_audio_channels}' \
+            if (stream.channels or 0) > target.max_audio_channels else ''
+        if measured is not None:
+            return f'-filter:{output} {loudnorm_filter(measured, self.loudness_target)} ' \
+                   f'-c:{output} aac -b:{output} 128k -ar:{output} 48000{downmix}'
+        return f'-c:{output} copy' if compliant else f'-c:{output} aac{downmix}'
+
+    def encode_chunks(self, input_path, chunk_folder, video_settings, pin):
+        """
+        Splits the main video stream on keyframes, encodes the segments in parallel and
+        returns the concat list of the encoded segments.
+        The chunks share the threads and cpus of the job, video_settings being the video_encode arguments.
+        """
+        chunk_threads = max(1, self.threads_per_job // self.chunk_jobs)
+        video_encode = self.video_encode(*video_settings, threads=chunk_threads)
+        shutil.rmtree(chunk_folder, ignore_errors=True)
+        os.mkdir(chunk_folder)
+
+        print(f'Splitting in {self.chunk_length}s chunks')
+        command = f'ffmpeg -v warning -fflags +genpts -i "{input_path}" -map 0:v:0 -c copy ' \
+                  f'-f segment -segment_time {self.chunk_length} -reset_timestamps 1 ' \
+                  f'"{os.path.join(chunk_folder, "source%05d.mkv")}"'
+        check_call(shlex.split(command))
+
+        def encode_chunk(source):
+            encoded = source.replace('source', 'encoded')
+            chunk_command = f'ffmpeg -v error -i "{os.path.join(chunk_folder, source)}" ' \
+                            f'-threads {chunk_threads} -map 0:v:0 {video_encode} ' \
+                            f'"{os.path.join(chunk_folder, encoded)}"'
+            check_call(pin + shlex.split(chunk_command))
+            return encoded
+
+        sources = sorted(f for f in os.listdir(chunk_folder) if f.startswith('source'))
+        print(f'Encoding {len(sources)} chunks, {self.chunk_jobs} at once with {chunk_threads} threads each')
+        with ThreadPoolExecutor(max_workers=self.chunk_jobs) as executor:
+            encoded_chunks = list(executor.map(encode_chunk, sources))
+
+        concat_list = os.path.join(chunk_folder, 'concat.txt')
+        with open(concat_list, 'w', encoding='utf-8') as f:
+            for encoded in encoded_chunks:
+                path = os.path.abspath(os.path.join(chunk_folder, encoded)).replace("'", "'\\''")
+                f.write(f"file '{path}'\n")
+        return concat_list
 
     def normalize(self, item):
         print(f'--- Normalizing ---')
         input_path = os.path.join(self.NORMALIZING_FOLDER, item.local_file)
-        output_path = os.path.join(self.OUTPUT_FOLDER, item.local_file)
+        output_path = os.path.join(self.TEMP_FOLDER, item.local_file)
 
         command = f'ffmpeg-normalize "{input_path}" -v -pr -c:a aac -b:a 128k -ar 48000 -o "{output_path}"'
 
-        try:
-            check_call(shlex.split(command))
-            os.remove(input_path)
-
-        except CalledProcessError:
-            print('Normalization failed !')
-            time.sleep(30)
-            self.normalize(item)
+        check_call(shlex.split(command))
+        os.rename(output_path,
+                  os.path.join(self.OUTPUT_FOLDER, item.local_file))
+        os.remove(input_path)
 
     def upload(self, item):
+        if item.remote_path is None:
+            print(f'No .info for {item.local_file}, leaving it in {self.OUTPUT_FOLDER}')
+            return
         print(f'--- Uploading ---\nTo {os.path.dirname(item.remote_path)}')
-        command_dirs = ['ssh', self.ssh,
-                        'mkdir', '-p', shlex.quote(os.path.dirname(item.remote_path))]
-        command = ['scp', scp_option,
-                   os.path.join(self.OUTPUT_FOLDER, item.local_file),
-                   f'{self.ssh}:{shlex.quote(os.path.join(os.path.dirname(item.remote_path), item.local_file))}']
-        command_duplicate = ['ssh', self.ssh,
-                             'rm', '-f', shlex.quote(item.remote_path)]
-
+        local_path = os.path.join(self.OUTPUT_FOLDER, item.local_file)
+
+        # A retried upload skips the transfer once the remote file matches
+        self.transfer.upload(local_path, os.path.join(os.path.dirname(item.remote_path), item.local_file))
+        self.uploaded(item, os.path.getsize(local_path))
+        os.remove(local_path)
+
+    def uploaded(self, item, size):
+        if item.remote_path is None:
+            return
+        if item.remote_file != item.local_file:
+            print(f'Removing old file {item.remote_file}')
+            self.transfer.remove(item.remote_path)
+            handled_index.set_state(item.remote_path, 'replaced')
+        handled_index.add(os.path.join(os.path.dirname(item.remote_path), item.local_file), size, 'uploaded',
+                          duration=item.duration)
+        if self.refresher is not None:
+            self.refresher.refresh(os.path.dirname(item.remote_path))
+
+        info = os.path.join(self.TEMP_FOLDER, item.name + '.info')
+        os.remove(info)
+
+    def enqueue(self, stage, item, block):
+        with self.lock:
+            if not block and item.name in self.in_flight:
+                return False
+            self.in_flight.add(item.name)
+
+        priority = item.need_video_convert() if stage == 'convert' else False
         try:
-            check_call(command_dirs)
-            check_call(command)
-            if item.remote_file != item.local_file:
-                print(f'Removing old file {item.remote_file}')
-                check_call(command_duplicate)
-
-            os.remove(os.path.join(self.OUTPUT_FOLDER, item.local_file))
-            info = os.path.join(self.TEMP_FOLDER, item.name + '.info')
-            os.remove(info)
-
-        except CalledProcessError:
-            print('Upload failed !')
-            time.sleep(30)
-            self.upload(item)
-
-    def run(self):
-        waiting = False
+            self.queues[stage].put((priority, next(self.order), item), block=block)
+            return True
+        except Full:
+            with self.lock:
+                self.in_flight.discard(item.name)
+            return False
+
+    def stage_worker(self, stage, worker):
+        """
+        Runs the items of a stage one after the other. A failed item is dropped from the stage after a delay,
+        the next folder scan queueing it again.
+        """
         while True:
-            converting = get_pending_items(self.CONVERTING_FOLDER)
-            normalizing = get_pending_items(self.NORMALIZING_FOLDER)
-            uploading = get_pending_items(self.OUTPUT_FOLDER)
-
-            if converting or normalizing or uploading:
-                waiting = False
-
-                for item in uploading:
-                    print(f'\n{item}')
-                    self.upload(item)
-
-                for item in converting:
-                    if not item.need_video_convert():
-                        print(f'\n{item}')
-                        self.convert(item)
-                        self.normalize(item)
-                        self.upload(item)
-
-                if normalizing:
-                    for item in normalizing:
-                        print(f'\n{item}')
-                        self.normalize(item)
-                        self.upload(item)
-
+            _, _, item = self.queues[stage].get()
+            print(f'\n{item}')
+            try:
+                if stage == 'convert':
+                    self.convert(item, job=worker)
                 else:
-                    for item in converting:
-                        if item.need_video_convert():
-                            print(f'\n{item}')
-                            self.convert(item)
-                            break
-
+                    getattr(self, stage)(item)
+            except Exception as e:
+                print(f'{stage.capitalize()} of {item.name} failed ({e!r}), retry soon...')
+                time.sleep(30)
+                with self.lock:
+                    self.in_flight.discard(item.name)
+                watcher.wake()
+                continue
+
+            if self.next_stage[stage] is None:
+                with self.lock:
+                    self.in_flight.discard(item.name)
             else:
-                if not waiting:
-                    print('\nWaiting for new files...')
-                    waiting = True
+                self.enqueue(self.next_stage[stage], item, block=True)
 
-                else:
-                    time.sleep(1)
+    def run(self):
+        for stage, workers in self.stage_workers.items():
+            for worker in range(workers):
+                threading.Thread(target=self.stage_worker, args=(stage, worker), daemon=True).start()
+
+        waiting = False
+        while True:
+            backlog = False
+            for stage, folder in self.stage_folders.items():
+                with self.lock:
+                    in_flight = set(self.in_flight)
+                for item in get_pending_items(folder, ignore=in_flight):
+                    if self.enqueue(stage, item, block=False):
+                        waiting = False
+                    else:
+                        backlog = True
+
+            with self.lock:
+                idle = not self.in_flight
+            if idle and not waiting:
+                print('\nWaiting for new files...')
+                waiting = True
+
+            watcher.wait(60 if backlog else None)
 
 
 if __name__ == '__main__':
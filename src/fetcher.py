@@ -1,14 +1,40 @@
 import os
-import shlex
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
-from subprocess import check_call, CalledProcessError
+from xml.etree.ElementTree import fromstring, iterparse, ParseError
 
-from requests import get
-from requests.exceptions import ConnectionError
-from xmltodict import parse
+import numpy as np
+from requests.exceptions import ChunkedEncodingError, ReadTimeout
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
 
-from modules import RemoteItem, Library, scp_option
+from modules import PlexClient, RemoteItem, Library, handled_index, target, watcher, load_state, save_state
+from scheduler import AdmissionControl, DownloadScheduler
+from transfer import make_transfer
+from webhook import WebhookListener
+
+
+class LibrarySnapshot:
+    """
+    Persisted view of the Plex libraries: for every video (ratingKey) of a library its pending items,
+    the highest updatedAt/addedAt seen so far and the time of the last full scan.
+    """
+    VERSION = 3
+
+    def __init__(self, path):
+        self.path = path
+        self.libraries = load_state(path, self.VERSION, {})
+        self.lock = threading.Lock()
+
+    def library(self, library_id):
+        with self.lock:
+            return dict(self.libraries.get(library_id, {'watermark': 0, 'full_scan': 0, 'videos': {}}))
+
+    def update(self, library_id, state):
+        with self.lock:
+            self.libraries[library_id] = state
+            save_state(self.path, self.VERSION, self.libraries)
 
 
 class PlexFetcher:
@@ -18,130 +44,265 @@ class PlexFetcher:
 
         self.TEMP_FOLDER = config['FOLDERS']['TEMP']
         self.CONVERTING_FOLDER = config['FOLDERS']['CONVERTING']
-
-        if not os.path.exists(self.TEMP_FOLDER):
-            os.mkdir(self.TEMP_FOLDER)
-        if not os.path.exists(self.CONVERTING_FOLDER):
-            os.mkdir(self.CONVERTING_FOLDER)
-
-        self.plex_token = config['PLEX']['TOKEN']
-        self.plex_url = f'http://{config["PLEX"]["URL"]}:{config["PLEX"]["PORT"]}'
+        self.NORMALIZING_FOLDER = config['FOLDERS']['NORMALIZING']
+        self.OUTPUT_FOLDER = config['FOLDERS']['DONE']
+        pipeline_folders = [self.TEMP_FOLDER, self.CONVERTING_FOLDER, self.NORMALIZING_FOLDER, self.OUTPUT_FOLDER]
+
+        for folder in pipeline_folders:
+            if not os.path.exists(folder):
+                os.mkdir(folder)
+            watcher.watch(folder)
+
+        self.library_workers = config['FETCHER'].getint('LIBRARY_WORKERS')
+        self.plex = PlexClient(f'http://{config["PLEX"]["URL"]}:{config["PLEX"]["PORT"]}', config['PLEX']['TOKEN'],
+                               timeout=(config['PLEX'].getfloat('CONNECT_TIMEOUT'),
+                                        config['PLEX'].getfloat('READ_TIMEOUT')),
+                               retries=config['PLEX'].getint('RETRIES'),
+                               pool_size=self.library_workers)
         self.ssh = f'{config["SSH"]["USER"]}@{config["PLEX"]["URL"]}'
-
-    def get_wrapper(self, url):
-        failed = False
-        while True:
-            try:
-                response = get(url, params={'X-Plex-Token': self.plex_token}, timeout=(2, None))
-
-                if failed:
-                    print(' success !', flush=True)
-                return response
-
-            except ConnectionError:
-                if failed:
-                    print('.', end='', flush=True)
-                else:
-                    print('Failed to get response.', end='', flush=True)
-                    failed = True
-                time.sleep(3)
+        self.transfer = make_transfer(config['TRANSFER'], self.ssh)
+        self.parallel_downloads = config['TRANSFER'].getint('PARALLEL')
+        self.downloading = {}
+        self.lock = threading.Lock()
+
+        self.page_size = config['FETCHER'].getint('PAGE_SIZE')
+        self.scan_interval = config['FETCHER'].getint('SCAN_INTERVAL')
+        self.full_scan_interval = config['FETCHER'].getint('FULL_SCAN_INTERVAL')
+        self.snapshot = LibrarySnapshot(config['STATE']['LIBRARY_SNAPSHOT'])
+        self.scheduler = DownloadScheduler(config['SCHEDULER'])
+        self.admission = AdmissionControl(config['ADMISSION'], pipeline_folders, self.TEMP_FOLDER, handled_index)
+
+        self.requested_scans = set()
+        self.webhook = None
+        if config['FETCHER'].getint('WEBHOOK_PORT'):
+            self.webhook = WebhookListener(config['FETCHER'].getint('WEBHOOK_PORT'), self.request_scan)
 
     def get_libraries(self):
-        response = self.get_wrapper(
-            f'{self.plex_url}/library/sections',
-        )
-        libraries = parse(response.content)['MediaContainer']['Directory']
-        libraries = [Library(library) for library in libraries]
-        libraries = sorted(libraries, key=lambda x: x.id)
+        response = self.plex.get('/library/sections')
+        libraries = fromstring(response.content).iter('Directory')
+        libraries = [Library(library) for library in libraries if library.get('type') in ('movie', 'show')]
+        libraries = sorted(libraries, key=lambda x: x.key)
 
         return libraries
 
-    def get_items(self, library):
-        response = self.get_wrapper(
-            f'{self.plex_url}/library/sections/{library.id}/allLeaves'
-        )
-        items = parse(response.content)['MediaContainer']['Video']
-
-        parsed_items = []
-        for item in items:
-            media_infos = item['Media']
-            if not isinstance(media_infos, list):
-                media_infos = [media_infos]
-            previous_path = None
-            for media_info in media_infos:
-                if previous_path is None:
-                    previous_path = media_info['Part']['@file']
-                else:
-                    if media_info['Part']['@file'] == previous_path:
-                        continue
-                    else:
-                        previous_path = media_info['Part']['@file']
-
-                parsed_items.append(RemoteItem(item['@title'], media_info))
-
-        return parsed_items
-
-    def get_pending_items(self, library):
-        all_items = self.get_items(library)
-        pending_items = [item for item in all_items if item.reasons]
-        return pending_items, len(all_items)
+    def get_items(self, library, since=None):
+        """
+        Yields (ratingKey, updated, parts) for every video of the library, or only for those
+        updated or added after since.
+        Pages are requested X-Plex-Container-Size videos at a time and parsed while they stream in,
+        every video being dropped from the tree once its parts are read. A page cut while streaming is
+        requested again, skipping the videos already yielded.
+        """
+        path = f'/library/sections/{library.key}/allLeaves'
+        if since is not None:
+            path += f'?updatedAt>>={since}'
+        params = {'X-Plex-Container-Size': self.page_size,
+                  'excludeFields': 'summary',
+                  'excludeElements': 'Genre,Director,Writer,Role,Country,Collection,Label,Field,Image'}
+
+        start = 0
+        while True:
+            params['X-Plex-Container-Start'] = start
+            count, total = 0, None
+            for attempt in range(self.plex.retries + 1):
+                try:
+                    for position, video, total in self.read_page(path, params):
+                        if position == count:
+                            count += 1
+                            yield self.parse_video(video)
+                    break
+                except (ChunkedEncodingError, ReadTimeout, ProtocolError, ReadTimeoutError, ParseError) as e:
+                    if attempt == self.plex.retries:
+                        raise
+                    delay = min(2 ** attempt, 60)
+                    print(f'Reading {library.name} failed ({e!r}), restarting the page in {delay}s')
+                    time.sleep(delay)
+
+            start += count
+            if count < self.page_size or (total is not None and start >= int(total)):
+                return
+
+    def read_page(self, path, params):
+        """
+        Yields (position, Video element, totalSize) for every video of a page while it streams in, each video
+        being dropped from the tree once the next one is read.
+        """
+        response = self.plex.get(path, params=params, stream=True)
+        response.raw.decode_content = True
+        try:
+            position, total, root = 0, None, None
+            for event, element in iterparse(response.raw, events=('start', 'end')):
+                if event == 'start':
+                    if root is None:
+                        root = element
+                        total = element.get('totalSize')
+                elif element.tag == 'Video':
+                    yield position, element, total
+                    position += 1
+                    root.clear()
+        finally:
+            response.close()
+
+    @staticmethod
+    def parse_video(video):
+        """
+        Returns (ratingKey, updated, parts), parts being the (title, media attributes, part attributes)
+        of every distinct file of the video.
+        """
+        parts = []
+        previous_path = None
+        for media in video.iter('Media'):
+            part = media.find('Part')
+            if part is None or part.get('file') == previous_path:
+                continue
+            previous_path = part.get('file')
+
+            parts.append((video.get('title'), media.attrib, part.attrib))
+
+        updated = max(int(video.get('updatedAt', 0)), int(video.get('addedAt', 0)))
+        return video.get('ratingKey'), updated, parts
+
+    def get_pending_items(self, library, refresh=True):
+        state = self.snapshot.library(library.key)
+        if not refresh:
+            pending_items = [item for items in state['videos'].values() for item in items]
+            return pending_items, len(state['videos'])
+
+        full_scan = time.time() - state['full_scan'] >= self.full_scan_interval
+        if full_scan:
+            state['videos'] = {}
+            state['watermark'] = 0
+        else:
+            state['videos'] = dict(state['videos'])
+
+        # Items updated during the second of the last watermark may have been missed, ask for them again
+        since = None if full_scan else state['watermark'] - 1
+        # Reasons are evaluated a page of videos at a time, only the items needing work are kept
+        page, videos = [], 0
+        for key, updated, video_parts in self.get_items(library, since=since):
+            state['videos'][key] = []
+            page.extend((key, part) for part in video_parts)
+            state['watermark'] = max(state['watermark'], updated)
+            videos += 1
+            if videos >= self.page_size:
+                self.add_pending(state, page)
+                page, videos = [], 0
+        self.add_pending(state, page)
+        if full_scan:
+            state['full_scan'] = time.time()
+        self.snapshot.update(library.key, state)
+
+        pending_items = [item for items in state['videos'].values() for item in items]
+        return pending_items, len(state['videos'])
+
+    @staticmethod
+    def add_pending(state, page):
+        """
+        Adds the items of a page of (video key, part) rows needing work to the videos of a library state.
+        Rows Plex returns incomplete (no duration, codec...) are skipped with a warning.
+        """
+        needs_work = target.needs_work([media for _, (_, media, _) in page], [part for _, (_, _, part) in page])
+        for row in np.flatnonzero(needs_work):
+            key, part = page[row]
+            try:
+                item = RemoteItem(*part)
+            except (KeyError, TypeError, ValueError, ZeroDivisionError) as e:
+                print(f'Skipping {part[0]} ({part[2].get("file")}), incomplete Plex metadata ({e!r})')
+                continue
+            if item.reasons:
+                state['videos'][key].append(item)
 
     def download(self, item):
         print(f'--- Downloading {item.name} ---')
-        command = ['scp', scp_option, f'{self.ssh}:{shlex.quote(item.remote_path)}', self.TEMP_FOLDER]
-
+        converting_path = os.path.join(self.CONVERTING_FOLDER, item.remote_file)
+        already_converting = self.transfer.same_file(converting_path, item.remote_path)
+        if already_converting:
+            print(f'{item.remote_file} already waiting for conversion, skipping')
+        else:
+            self.transfer.download(item.remote_path, os.path.join(self.TEMP_FOLDER, item.remote_file), size=item.size)
+
+        with open(os.path.join(self.TEMP_FOLDER, f'{item.remote_file.rsplit(".", 1)[0]}.info'), 'w') as f:
+            f.write(item.remote_path)
+        if not already_converting:
+            os.rename(os.path.join(self.TEMP_FOLDER, item.remote_file), converting_path)
+        handled_index.add(item.remote_path, item.size, 'downloaded', duration=item.duration,
+                          expected_size=int(item.plan.size), cost=item.plan.cost)
+
+    def download_worker(self, item):
         try:
-            check_call(command)
-
-            with open(os.path.join(self.TEMP_FOLDER, f'{item.remote_file.rsplit(".", 1)[0]}.info'), 'w') as f:
-                f.write(item.remote_path)
-            os.rename(os.path.join(self.TEMP_FOLDER, item.remote_file),
-                      os.path.join(self.CONVERTING_FOLDER, item.remote_file))
-
-        except CalledProcessError:
-            print('Download failed, retry soon...')
-            time.sleep(30)
             self.download(item)
-
-    def folder_is_full(self):
-        return sum(f.endswith('.info') for f in os.listdir(self.TEMP_FOLDER)) >= 2
+        except Exception as e:
+            print(f'Download of {item.name} failed ({e})')
+        finally:
+            with self.lock:
+                del self.downloading[item.remote_path]
+            watcher.wake()
 
     def not_downloaded(self, item):
         return not os.path.exists(os.path.join(self.TEMP_FOLDER, f'{item.remote_file.rsplit(".", 1)[0]}.info'))
 
+    def request_scan(self, section=None):
+        """
+        Asks the main loop for a scan of a library section, of every library when section is None.
+        """
+        with self.lock:
+            self.requested_scans.add(section)
+        watcher.wake()
+
+    def scan(self, sections=None):
+        """
+        Scans the libraries whose section key is in sections (all of them when None), the pending items of
+        the others are taken from the snapshot.
+        """
+        print(f'\n--- Fetching libraries --- ({time.strftime("%X", time.localtime())})')
+
+        libraries = self.get_libraries()
+        refresh = [sections is None or library.key in sections for library in libraries]
+        with ThreadPoolExecutor(max_workers=self.library_workers) as executor:
+            scans = list(executor.map(self.get_pending_items, libraries, refresh))
+
+        queued = []
+        for library, (pending_items, count_items) in zip(libraries, scans):
+            with self.lock:
+                downloading = set(self.downloading)
+            items = [item for item in pending_items if item.remote_path not in downloading and
+                     not handled_index.is_handled(item) and self.not_downloaded(item)]
+            print(f'Library {library.name}: {len(pending_items)} pending, {count_items} total')
+            queued.extend(items)
+        self.scheduler.update(queued)
+        print(f'{len(self.scheduler)} items queued for download')
+
     def run(self):
-        done = []
+        executor = ThreadPoolExecutor(max_workers=self.parallel_downloads)
+        if self.webhook is not None:
+            self.webhook.start()
+        next_scan = 0
         while True:
-            try:
-                print(f'\n--- Fetching libraries --- ({time.strftime("%X", time.localtime())})')
-
-                for library in self.get_libraries():
-                    print(f'Library {library.name}: ', end='', flush=True)
-
-                    pending_items, count_items = self.get_pending_items(library)
-                    items = [item for item in pending_items
-                             if item not in done and self.not_downloaded(item)]
-                    size = len(items)
-                    i = 0
-
-                    print(f'{len(pending_items)} pending, {count_items} total')
-                    for item in items:
-                        print(f'Entry {i + 1}/{size}\n{item}')
-
-                        while self.folder_is_full():
-                            time.sleep(1)
-
-                        while self.not_downloaded(item):
-                            self.download(item)
-
-                        done.append(item)
-                        i += 1
-                        print('', end='\n')
-
-            except Exception as e:
-                print(f'Library updating ({e}), retying soon...')
-
-            time.sleep(600)
+            with self.lock:
+                sections, self.requested_scans = self.requested_scans, set()
+            if time.time() >= next_scan or None in sections:
+                sections = None
+                next_scan = time.time() + self.scan_interval
+            if sections is None or sections:
+                try:
+                    self.scan(sections)
+                except Exception as e:
+                    print(f'Library updating ({e}), retying soon...')
+
+            with self.lock:
+                downloading = list(self.downloading.values())
+            item = None
+            # The pipeline is only measured when something is waiting for a download slot
+            if len(downloading) < self.parallel_downloads and len(self.scheduler):
+                item = self.scheduler.pop(self.admission.check(downloading))
+            if item is None:
+                watcher.wait(max(next_scan - time.time(), 0))
+                continue
+
+            print(f'\n{item}')
+            with self.lock:
+                self.downloading[item.remote_path] = item
+            executor.submit(self.download_worker, item)
 
 
 if __name__ == '__main__':
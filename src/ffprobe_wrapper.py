@@ -2,211 +2,215 @@
 Python wrapper for ffprobe command line tool. ffprobe must exist in the path.
 """
 import functools
+import json
 import operator
 import os
-import pipes
-import platform
-import re
+import shutil
 import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
 class FFProbeError(Exception):
     pass
 
 
+@functools.lru_cache(maxsize=None)
+def _ffprobe_binary():
+    binary = shutil.which('ffprobe')
+    if binary is None:
+        raise IOError('ffprobe not found.')
+    return binary
+
+
+def _to_number(value, kind):
+    try:
+        return kind(value)
+    except (TypeError, ValueError):
+        return None
+
+
 class FFProbe:
     """
     FFProbe wraps the ffprobe command and pulls the data into an object form::
         metadata=FFProbe('multimedia-file.mov')
+
+    A single ffprobe process is spawned per file, its JSON output holds both streams and format.
+    Format level bit rate (bps) and duration (seconds) are exposed as numbers, None if unknown.
     """
 
+    __slots__ = ('path_to_video', 'metadata', 'bit_rate', 'duration',
+                 'streams', 'video', 'audio', 'subtitle', 'attachment')
+
     def __init__(self, path_to_video):
         self.path_to_video = path_to_video
 
-        try:
-            with open(os.devnull, 'w') as tempf:
-                subprocess.check_call(["ffprobe", "-h"], stdout=tempf, stderr=tempf)
-        except FileNotFoundError:
-            raise IOError('ffprobe not found.')
-
-        if os.path.isfile(self.path_to_video):
-            if platform.system() == 'Windows':
-                cmd = ["ffprobe", "-show_streams", self.path_to_video]
-            else:
-                cmd = ["ffprobe -show_streams " + pipes.quote(self.path_to_video)]
-
-            p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-            (stdout, stderr) = p.communicate(5)
-
-            stream = False
-            self.streams = []
-            self.video = []
-            self.audio = []
-            self.subtitle = []
-            self.attachment = []
-
-            for line in stdout.splitlines():
-                line = line.decode('UTF-8')
-
-                if '[STREAM]' in line:
-                    stream = True
-                    data_lines = []
-                elif '[/STREAM]' in line and stream:
-                    stream = False
-                    # noinspection PyUnboundLocalVariable
-                    self.streams.append(FFStream(data_lines))
-                elif stream:
-                    data_lines.append(line)
-
-            self.metadata = {}
-            is_metadata = False
-            stream_metadata_met = False
-
-            for line in stderr.splitlines():
-                line = line.decode('UTF-8')
-
-                if 'Metadata:' in line and not stream_metadata_met:
-                    is_metadata = True
-                elif 'Stream #' in line:
-                    is_metadata = False
-                    stream_metadata_met = True
-                elif 'Chapter #' in line:
-                    is_metadata = False
-                    stream_metadata_met = False
-                elif is_metadata:
-                    splits = line.split(',')
-                    for s in splits:
-                        m = re.search(r'(\w+)\s*:\s*(.*)$', s)
-                        try:
-                            self.metadata[m.groups()[0]] = m.groups()[1].strip()
-
-                        except Exception as _:
-                            pass
-
-                if '[STREAM]' in line:
-                    stream = True
-                    data_lines = []
-                elif '[/STREAM]' in line and stream:
-                    stream = False
-                    self.streams.append(FFStream(data_lines))
-                elif stream:
-                    data_lines.append(line)
-
-            p.stdout.close()
-            p.stderr.close()
-
-            for stream in self.streams:
-                if stream.is_audio():
-                    self.audio.append(stream)
-                elif stream.is_video():
-                    self.video.append(stream)
-                elif stream.is_subtitle():
-                    self.subtitle.append(stream)
-                elif stream.is_attachment():
-                    self.attachment.append(stream)
-        else:
+        if not os.path.isfile(self.path_to_video):
             raise IOError('No such media file ' + self.path_to_video)
 
+        cmd = [_ffprobe_binary(), '-v', 'error', '-print_format', 'json', '-show_format', '-show_streams',
+               self.path_to_video]
+        p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if p.returncode:
+            raise FFProbeError(f'ffprobe failed on {self.path_to_video}: {p.stderr.decode("UTF-8").strip()}')
+
+        try:
+            data = json.loads(p.stdout.decode('UTF-8'))
+        except ValueError:
+            raise FFProbeError(f'Unreadable ffprobe output for {self.path_to_video}')
+
+        media_format = data.get('format', {})
+        self.metadata = media_format.get('tags', {})
+        self.bit_rate = _to_number(media_format.get('bit_rate'), int)
+        self.duration = _to_number(media_format.get('duration'), float)
+
+        self.streams = []
+        self.video = []
+        self.audio = []
+        self.subtitle = []
+        self.attachment = []
+
+        streams_by_type = {'video': self.video, 'audio': self.audio,
+                           'subtitle': self.subtitle, 'attachment': self.attachment}
+        for stream_data in data.get('streams', []):
+            stream = FFStream(stream_data)
+            self.streams.append(stream)
+            streams_of_type = streams_by_type.get(stream.codec_type)
+            if streams_of_type is not None:
+                streams_of_type.append(stream)
+
+    @classmethod
+    def batch(cls, paths, max_workers=4):
+        """
+        Probes several files in a bounded pool of workers and yields (path, FFProbe) as each one finishes.
+        A file that can not be probed yields its exception instead of stopping the whole batch.
+        """
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(cls, path): path for path in paths}
+            for future in as_completed(futures):
+                try:
+                    yield futures[future], future.result()
+                except (IOError, FFProbeError) as e:
+                    yield futures[future], e
+
     def __repr__(self):
-        return "<FFprobe: {metadata}, {video}, {audio}, {subtitle}, {attachment}>".format(**vars(self))
+        return "<FFprobe: {s.metadata}, {s.video}, {s.audio}, {s.subtitle}, {s.attachment}>".format(s=self)
+
+
+def _frame_rate(value):
+    try:
+        return round(functools.reduce(operator.truediv, map(int, value.split('/'))))
+    except (AttributeError, ValueError):
+        return None
+    except ZeroDivisionError:
+        return 0
 
 
 class FFStream:
     """
-    An object representation of an individual stream in a multimedia file.
+    A compact representation of an individual stream in a multimedia file.
+    Only the fields used by the accessors are kept, numeric fields given as strings by ffprobe
+    (frame rate, frame count, duration, bit rate) are parsed together on first access.
     """
-
-    def __init__(self, data_lines):
-        for line in data_lines:
-            self.__dict__.update({key: value for key, value, *_ in [line.strip().split('=')]})
-
-            try:
-                self.__dict__['framerate'] = round(
-                    functools.reduce(
-                        operator.truediv, map(int, self.__dict__.get('avg_frame_rate', '').split('/'))
-                    )
-                )
-
-            except ValueError:
-                self.__dict__['framerate'] = None
-            except ZeroDivisionError:
-                self.__dict__['framerate'] = 0
+    FIELDS = ('index', 'codec_type', 'codec_name', 'codec_long_name', 'codec_tag_string', 'profile',
+              'width', 'height', 'pix_fmt', 'channels', 'channel_layout', 'sample_rate')
+    RAW_FIELDS = ('avg_frame_rate', 'nb_frames', 'duration', 'bit_rate')
+
+    __slots__ = FIELDS + ('language_tag', '_raw', '_typed')
+
+    def __init__(self, data):
+        for field in self.FIELDS:
+            setattr(self, field, data.get(field))
+        self.language_tag = data.get('tags', {}).get('language')
+        self._raw = tuple(data.get(field) for field in self.RAW_FIELDS)
+        self._typed = None
+
+    def __getstate__(self):
+        return tuple(getattr(self, field) for field in self.__slots__)
+
+    def __setstate__(self, state):
+        for field, value in zip(self.__slots__, state):
+            setattr(self, field, value)
+
+    def _typed_value(self, position):
+        if self._typed is None:
+            avg_frame_rate, nb_frames, duration, bit_rate = self._raw
+            self._typed = (_frame_rate(avg_frame_rate),
+                           _to_number(nb_frames, int),
+                           _to_number(duration, float),
+                           _to_number(bit_rate, int))
+        return self._typed[position]
+
+    @property
+    def framerate(self):
+        """
+        Average frame rate rounded to an integer, 0 if undefined and None if unknown.
+        """
+        return self._typed_value(0)
 
     def __repr__(self):
         if self.is_video():
-            template = "<Stream: #{index} [{codec_type}] {codec_long_name}, {framerate}, ({width}x{height})>"
+            template = "<Stream: #{s.index} [{s.codec_type}] {s.codec_long_name}, {s.framerate}, " \
+                       "({s.width}x{s.height})>"
 
         elif self.is_audio():
-            template = "<Stream: #{index} [{codec_type}] {codec_long_name}, channels: {channels} ({channel_layout}), " \
-                       "{sample_rate}Hz> "
+            template = "<Stream: #{s.index} [{s.codec_type}] {s.codec_long_name}, channels: {s.channels} " \
+                       "({s.channel_layout}), {s.sample_rate}Hz> "
 
         elif self.is_subtitle() or self.is_attachment():
-            template = "<Stream: #{index} [{codec_type}] {codec_long_name}>"
+            template = "<Stream: #{s.index} [{s.codec_type}] {s.codec_long_name}>"
 
         else:
             template = ''
 
-        return template.format(**self.__dict__)
+        return template.format(s=self)
 
     def is_audio(self):
         """
         Is this stream labelled as an audio stream?
         """
-        return self.__dict__.get('codec_type', None) == 'audio'
+        return self.codec_type == 'audio'
 
     def is_video(self):
         """
         Is the stream labelled as a video stream.
         """
-        return self.__dict__.get('codec_type', None) == 'video'
+        return self.codec_type == 'video'
 
     def is_subtitle(self):
         """
         Is the stream labelled as a subtitle stream.
         """
-        return self.__dict__.get('codec_type', None) == 'subtitle'
+        return self.codec_type == 'subtitle'
 
     def is_attachment(self):
         """
         Is the stream labelled as a attachment stream.
         """
-        return self.__dict__.get('codec_type', None) == 'attachment'
+        return self.codec_type == 'attachment'
 
     def frame_size(self):
         """
         Returns the pixel frame size as an integer tuple (width,height) if the stream is a video stream.
-        Returns None if it is not a video stream.
+        Returns None if it is not a video stream or its size is unknown.
         """
-        size = None
-        if self.is_video():
-            width = self.__dict__['width']
-            height = self.__dict__['height']
-
-            if width and height:
-                try:
-                    size = (int(width), int(height))
-                except ValueError:
-                    raise FFProbeError("None integer size {}:{}".format(width, height))
-        else:
+        if not (self.is_video() and self.width and self.height):
             return None
-
-        return size
+        return self.width, self.height
 
     def pixel_format(self):
         """
         Returns a string representing the pixel format of the video stream. e.g. yuv420p.
         Returns none is it is not a video stream.
         """
-        return self.__dict__.get('pix_fmt', None)
+        return self.pix_fmt
 
     def frames(self):
         """
         Returns the length of a video stream in frames. Returns 0 if not a video stream.
         """
         if self.is_video() or self.is_audio():
-            try:
-                frame_count = int(self.__dict__.get('nb_frames', ''))
-            except ValueError:
+            frame_count = self._typed_value(1)
+            if frame_count is None:
                 raise FFProbeError('None integer frame count')
         else:
             frame_count = 0
@@ -219,9 +223,8 @@ class FFStream:
         Returns 0.0 if not a video stream.
         """
         if self.is_video() or self.is_audio():
-            try:
-                duration = float(self.__dict__.get('duration', ''))
-            except ValueError:
+            duration = self._typed_value(2)
+            if duration is None:
                 raise FFProbeError('None numeric duration')
         else:
             duration = 0.0
@@ -232,31 +235,31 @@ class FFStream:
         """
         Returns language tag of stream. e.g. eng
         """
-        return self.__dict__.get('TAG:language', None)
+        return self.language_tag
 
     def codec(self):
         """
         Returns a string representation of the stream codec.
         """
-        return self.__dict__.get('codec_name', None)
+        return self.codec_name
 
     def codec_description(self):
         """
         Returns a long representation of the stream codec.
         """
-        return self.__dict__.get('codec_long_name', None)
+        return self.codec_long_name
 
     def codec_tag(self):
         """
         Returns a short representative tag of the stream codec.
         """
-        return self.__dict__.get('codec_tag_string', None)
+        return self.codec_tag_string
 
     def bit_rate(self):
         """
         Returns bit_rate as an integer in bps
         """
-        try:
-            return int(self.__dict__.get('bit_rate', ''))
-        except ValueError:
+        bit_rate = self._typed_value(3)
+        if bit_rate is None:
             raise FFProbeError('None integer bit_rate')
+        return bit_rate
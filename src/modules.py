@@ -1,23 +1,38 @@
 import os
-import platform
+import pickle
+import sqlite3
+import threading
+import time
 from configparser import ConfigParser
 from difflib import SequenceMatcher
+from xml.etree.ElementTree import fromstring
 
-import psutil
 from bs4 import BeautifulSoup
-from requests import get, session
+from requests import get, session, Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ChunkedEncodingError, ConnectionError, HTTPError, RequestException, Timeout
 
 from ffprobe_wrapper import FFProbe
+from rules import TargetProfile
+from transfer import PARTIAL_SUFFIX
+from watcher import FolderWatcher
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 config = ConfigParser()
 config.read('config.ini')
 
 TEMP_FOLDER = config['FOLDERS']['TEMP']
-MAX_VIDEO_WIDTH = config['CONVERTER'].getint('MAX_VIDEO_WIDTH')
-MAX_VIDEO_HEIGHT = config['CONVERTER'].getint('MAX_VIDEO_HEIGHT')
 MAX_BITRATE = config['CONVERTER'].getint('MAX_BITRATE')
-
-scp_option = '-T' if platform.system() == 'Linux' else ''
+AVERAGE_BITRATE = config['CONVERTER'].getint('AVERAGE_BITRATE')
+PROBE_CACHE = config['STATE']['PROBE_CACHE']
+HANDLED_INDEX = config['STATE']['HANDLED_INDEX']
+PROBE_WORKERS = config['PROBE'].getint('WORKERS')
+STABLE_SECONDS = config['WATCHER'].getint('STABLE_SECONDS')
+POLL_INTERVAL = config['WATCHER'].getint('POLL_INTERVAL')
 
 
 def escape(string):
@@ -26,41 +41,335 @@ def escape(string):
     return string
 
 
-def has_handle(paths):
-    fpaths = {os.path.abspath(path): i for i, path in enumerate(paths)}
-    kpaths = fpaths.keys()
-    handles = [False] * len(fpaths)
-    for proc in psutil.process_iter():
+def load_state(path, version, default):
+    try:
+        with open(path, 'rb') as f:
+            saved_version, data = pickle.load(f)
+    except Exception as _:
+        return default
+    return data if saved_version == version else default
+
+
+def save_state(path, version, data):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump((version, data), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+class ProbeCache:
+    """
+    On disk cache of ffprobe results, keyed by absolute path and validated against (size, mtime, inode).
+    Several processes share the file, so only this process' changes are merged into it when saving, under a
+    lock held on a file next to it.
+    """
+    VERSION = 3
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = load_state(path, self.VERSION, {})
+        self.changes = {}
+
+    @staticmethod
+    def signature(path):
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+    def get(self, path):
+        path = os.path.abspath(path)
+        entry = self.entries.get(path)
         try:
-            of = set(p.path for p in proc.open_files())
-        except psutil.AccessDenied:
+            if entry is not None and entry[0] == self.signature(path):
+                return entry[1]
+        except FileNotFoundError:
             pass
-        else:
-            for inter in kpaths & of:
-                handles[fpaths[inter]] = True
-    return handles
+        return None
+
+    def put(self, path, metadata):
+        path = os.path.abspath(path)
+        entry = (self.signature(path), metadata)
+        self.entries[path] = entry
+        self.changes[path] = entry
+
+    def probe_many(self, paths, max_workers):
+        """
+        Yields (path, FFProbe) for every path, probing cache misses in parallel.
+        Failures are yielded as exceptions and not cached, the file may still be being written.
+        """
+        misses = []
+        for path in paths:
+            metadata = self.get(path)
+            if metadata is None:
+                misses.append(path)
+            else:
+                yield path, metadata
+
+        for path, metadata in FFProbe.batch(misses, max_workers):
+            if isinstance(metadata, Exception):
+                print(f'Could not probe {path} ({metadata})')
+                yield path, metadata
+                continue
+            try:
+                self.put(path, metadata)
+            except FileNotFoundError:
+                continue
+            yield path, metadata
+
+    def evict(self, folder, files):
+        folder = os.path.abspath(folder)
+        present = {os.path.join(folder, f) for f in files}
+        for path in [path for path in self.entries if os.path.dirname(path) == folder and path not in present]:
+            del self.entries[path]
+            self.changes[path] = None
+
+    def save(self):
+        if not self.changes:
+            return
+        with open(f'{self.path}.lock', 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = load_state(self.path, self.VERSION, {})
+            for path, entry in self.changes.items():
+                if entry is None:
+                    entries.pop(path, None)
+                else:
+                    entries[path] = entry
+            save_state(self.path, self.VERSION, entries)
+        self.entries = entries
+        self.changes = {}
+
+
+class HandledIndex:
+    """
+    On disk index of the remote files already taken care of, shared by the fetcher and the converter.
+    Entries are keyed by remote path and size, so a file replaced by another one is seen as new while the
+    converted file uploaded under the same name and the original it replaced are both known.
+    Downloads also record the expected size of their planned output and its estimated hours of work.
+    """
+    VERSION = 3
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        if self.connection.execute('PRAGMA user_version').fetchone()[0] < self.VERSION:
+            self.migrate()
+        self.connection.execute('CREATE TABLE IF NOT EXISTS encodes ('
+                                'finished REAL, media_seconds REAL, wall_seconds REAL, jobs INTEGER)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS bitrates ('
+                                'name TEXT PRIMARY KEY, bitrate INTEGER, score REAL, decided REAL)')
+
+    def migrate(self):
+        """
+        Creates the handled table, moving the entries of the previous one (keyed by remote path only) to it,
+        then adds the expected size and cost columns.
+        """
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+            if version < 1:
+                old_table = self.connection.execute("SELECT 1 FROM sqlite_master "
+                                                    "WHERE type = 'table' AND name = 'handled'").fetchone()
+                if old_table:
+                    self.connection.execute('ALTER TABLE handled RENAME TO handled_old')
+                self.connection.execute('CREATE TABLE handled ('
+                                        'remote_path TEXT, size INTEGER, duration INTEGER, state TEXT, '
+                                        'updated REAL, PRIMARY KEY (remote_path, size))')
+                if old_table:
+                    self.connection.execute('INSERT OR IGNORE INTO handled SELECT * FROM handled_old')
+                    self.connection.execute('DROP TABLE handled_old')
+            if version < 2:
+                self.connection.execute('ALTER TABLE handled ADD COLUMN expected_size INTEGER')
+            if version < 3:
+                self.connection.execute('ALTER TABLE handled ADD COLUMN cost REAL')
+            if version < self.VERSION:
+                self.connection.execute(f'PRAGMA user_version = {self.VERSION}')
+            self.connection.execute('COMMIT')
+        except sqlite3.Error:
+            self.connection.execute('ROLLBACK')
+            raise
+
+    def is_handled(self, item):
+        with self.lock:
+            row = self.connection.execute('SELECT 1 FROM handled WHERE remote_path = ? AND size = ?',
+                                          (item.remote_path, item.size)).fetchone()
+        return row is not None
+
+    def add(self, remote_path, size, state, duration=None, expected_size=None, cost=None):
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO handled VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    (remote_path, size, duration, state, time.time(), expected_size, cost))
+
+    def set_state(self, remote_path, state):
+        """
+        Sets the state of the downloaded versions of remote_path, leaving the uploaded ones alone.
+        """
+        with self.lock:
+            self.connection.execute("UPDATE handled SET state = ?, updated = ? "
+                                    "WHERE remote_path = ? AND state != 'uploaded'",
+                                    (state, time.time(), remote_path))
+
+    def queued(self):
+        """
+        Remote path, hours of work and expected output size of the items in the pipeline. Items downloaded
+        before both were recorded count as an encode of their duration keeping their size.
+        """
+        with self.lock:
+            return self.connection.execute("SELECT remote_path, COALESCE(cost, duration / 3600000.0), "
+                                           "COALESCE(expected_size, size) FROM handled "
+                                           "WHERE state IN ('downloaded', 'converting')").fetchall()
+
+    def add_encode(self, media_seconds, wall_seconds, jobs):
+        with self.lock:
+            self.connection.execute('INSERT INTO encodes VALUES (?, ?, ?, ?)',
+                                    (time.time(), media_seconds, wall_seconds, jobs))
+
+    def encode_speed(self, last=20):
+        """
+        Seconds of media encoded per second by the whole converter over the last encodes, None if unknown.
+        """
+        with self.lock:
+            rows = self.connection.execute('SELECT media_seconds, wall_seconds, jobs FROM encodes '
+                                           'ORDER BY finished DESC LIMIT ?', (last,)).fetchall()
+        wall_seconds = sum(row[1] for row in rows)
+        if not wall_seconds:
+            return None
+        return sum(row[0] for row in rows) / wall_seconds * rows[0][2]
+
+    def add_bitrate(self, name, bitrate, score):
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO bitrates VALUES (?, ?, ?, ?)',
+                                    (name, bitrate, score, time.time()))
+
+    def bitrate(self, name):
+        """
+        Bitrate picked by the quality search for name, None if it was not searched.
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT bitrate FROM bitrates WHERE name = ?', (name,)).fetchone()
+        return None if row is None else row[0]
+
+
+class PlexClient:
+    """
+    Pooled keep-alive HTTP session to the Plex server, retrying failed requests with a bounded exponential backoff.
+    Only connection errors, timeouts and server errors are retried, client errors (bad token, deleted section)
+    are raised at once.
+    """
+
+    def __init__(self, url, token, timeout, retries, pool_size):
+        self.url = url
+        self.timeout = timeout
+        self.retries = retries
+
+        self.session = Session()
+        self.session.params = {'X-Plex-Token': token}
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, path, params=None, stream=False):
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.get(self.url + path, params=params, timeout=self.timeout, stream=stream)
+                response.raise_for_status()
+                return response
+
+            except RequestException as e:
+                retry = isinstance(e, (ConnectionError, Timeout, ChunkedEncodingError)) or \
+                    (isinstance(e, HTTPError) and e.response is not None and e.response.status_code >= 500)
+                if not retry or attempt == self.retries:
+                    raise
+                delay = min(2 ** attempt, 60)
+                print(f'Failed to get response ({e}), retrying in {delay}s', flush=True)
+                time.sleep(delay)
+
+
+class PlexRefresher:
+    """
+    Asks Plex to scan only the folders files were uploaded to, in the library whose location is the longest
+    prefix of the folder. Folders are collected for delay seconds after the first one so that files landing
+    in the same folder trigger a single partial scan.
+    """
+
+    def __init__(self, plex, delay):
+        self.plex = plex
+        self.delay = delay
+        self.pending = set()
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def refresh(self, folder):
+        with self.lock:
+            self.pending.add(folder)
+            if self.timer is None:
+                self.timer = threading.Timer(self.delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def locations(self):
+        libraries = fromstring(self.plex.get('/library/sections').content).iter('Directory')
+        return [(location.get('path').rstrip('/'), library.get('key'))
+                for library in libraries for location in library.iter('Location')]
+
+    def flush(self):
+        with self.lock:
+            folders, self.pending, self.timer = self.pending, set(), None
+        try:
+            locations = self.locations()
+            for folder in sorted(folders):
+                matches = [(len(path), key) for path, key in locations
+                           if folder == path or folder.startswith(path + '/')]
+                if not matches:
+                    print(f'No Plex library contains {folder}, not refreshing')
+                    continue
+                self.plex.get(f'/library/sections/{max(matches)[1]}/refresh', params={'path': folder})
+                print(f'Plex refreshing {folder}')
+        except RequestException as e:
+            print(f'Plex refresh failed ({e}), new files will appear at the next library scan')
+
+
+target = TargetProfile(config['TARGET'], MAX_BITRATE, AVERAGE_BITRATE)
+probe_cache = ProbeCache(PROBE_CACHE)
+handled_index = HandledIndex(HANDLED_INDEX)
+watcher = FolderWatcher(STABLE_SECONDS, POLL_INTERVAL)
+
+
+def probe_items(paths):
+    items = []
+    for path, metadata in probe_cache.probe_many(paths, PROBE_WORKERS):
+        if isinstance(metadata, Exception):
+            continue
+        try:
+            items.append(LocalItem(metadata))
+        except Exception as e:
+            print(f'Unsupported media {path} ({e})')
+    probe_cache.save()
+    return items
 
 
-def get_pending_items(folder):
+def get_pending_items(folder, ignore=()):
     files = os.listdir(folder)
+    probe_cache.evict(folder, files)
     items = []
     if files:
-        paths = [os.path.join(folder, f) for f in files]
-        handles = has_handle(paths)
-        for path in [path for i, path in enumerate(paths) if not handles[i]]:
-            items.append(LocalItem(FFProbe(path)))
+        items = probe_items([os.path.join(folder, f) for f in watcher.ready(folder)
+                             if f.rsplit('.', 1)[0] not in ignore and not f.endswith(PARTIAL_SUFFIX)])
         return sorted(items, key=lambda x: x.name)
+    probe_cache.save()
     return items
 
 
 def get_new_items(folder, items):
-    files = [file for file in os.listdir(folder) if file not in [item.local_file for item in items]]
+    all_files = os.listdir(folder)
+    probe_cache.evict(folder, all_files)
+    known = {item.local_file for item in items}
+    files = [file for file in watcher.ready(folder) if file not in known and not file.endswith(PARTIAL_SUFFIX)]
     if files:
-        paths = [os.path.join(folder, f) for f in files]
-        handles = has_handle(paths)
-        for path in [path for i, path in enumerate(paths) if not handles[i]]:
-            items.append(LocalItem(FFProbe(path)))
+        items.extend(probe_items([os.path.join(folder, f) for f in files]))
         items.sort(key=lambda x: x.name)
+    else:
+        probe_cache.save()
 
 
 class Item:
@@ -78,41 +387,16 @@ class Item:
         self.audio_profile = None
         self.audio_channels = None
         self.container = None
+        self.size = None
         self.reasons = {}
+        self.plan = None
 
     def get_reasons(self):
-        if self.video_codec != 'h264' or self.video_profile != 'high':
-            self.reasons['Video codec'] = {'Codec': self.video_codec,
-                                           'Profile': self.video_profile}
-
-        if self.audio_codec != 'aac':
-            self.reasons['Audio codec'] = self.audio_codec
-        elif self.audio_codec == 'aac' and self.audio_profile != 'lc':
-            self.reasons['Audio codec'] = {'Codec': self.audio_codec,
-                                           'Profile': self.audio_profile}
-
-        if self.audio_channels not in ('1', '2'):
-            self.reasons['Audio channels'] = self.audio_channels
-
-        if self.bitrate > MAX_BITRATE:
-            self.reasons['High bitrate'] = {'Bitrate': self.bitrate,
-                                            'Resolution': self.video_resolution}
-
-        elif self.video_resolution[0] < MAX_VIDEO_HEIGHT and self.video_resolution[1] < MAX_VIDEO_WIDTH:
-            self.reasons['Low resolution'] = self.video_resolution
-
-        if self.container != 'mkv':
-            self.reasons['Container'] = self.container
-
-        if self.framerate != 'NTSC' and self.framerate != 'PAL' and (
-                int(self.framerate[:-1]) > 30):
-            self.reasons['Framerate'] = self.framerate
+        self.plan = target.plan(self)
+        self.reasons = {} if self.plan is None else self.plan.reasons
 
     def need_video_convert(self):
-        return 'Video codec' in self.reasons or \
-               'High bitrate' in self.reasons or \
-               'Framerate' in self.reasons or \
-               'Low resolution' in self.reasons
+        return self.plan is not None and self.plan.action == 'encode'
 
     def need_audio_convert(self):
         return 'Audio codec' in self.reasons or \
@@ -139,16 +423,20 @@ class LocalItem(Item):
         self.get_remote_path()
 
         self.video_codec = video.codec_name
-        self.video_profile = video.profile.lower()
+        self.video_profile = (video.profile or 'unknown').lower()
         self.audio_codec = audio.codec_name
         if self.audio_codec == 'aac':
-            self.audio_profile = audio.profile.lower()
-        self.audio_channels = audio.channels
+            self.audio_profile = (audio.profile or 'unknown').lower()
+        self.audio_channels = str(audio.channels)
         self.video_resolution = (int(video.height), int(video.width))
-        self.bitrate = int(metadata.metadata['bitrate'][:-5])
+        self.bitrate = (metadata.bit_rate or 0) // 1000
+        self.duration = int((metadata.duration or 0) * 1000)
         self.framerate = str(video.framerate)
         self.container = self.local_file[-3:]
+        self.size = os.path.getsize(metadata.path_to_video)
 
+        self.streams = metadata.streams
+        self.main_video = video
         self.subs_in_file = [sub.language() for sub in metadata.subtitle]
         self.subs_out_file = {}
         self.max_id = max([int(stream.index) for stream in metadata.streams])
@@ -264,30 +552,31 @@ class LocalItem(Item):
 
 
 class RemoteItem(Item):
-    def __init__(self, name, media_info):
+    def __init__(self, name, media, part):
         super().__init__()
 
         self.name = name
 
-        self.remote_path = media_info['Part']['@file']
+        self.remote_path = part['file']
         self.remote_file = os.path.basename(self.remote_path)
 
-        self.video_codec = media_info['@videoCodec']
-        self.video_profile = media_info['@videoProfile']
-        self.audio_codec = media_info['@audioCodec']
+        self.video_codec = media['videoCodec']
+        self.video_profile = media['videoProfile']
+        self.audio_codec = media['audioCodec']
         if self.audio_codec == 'aac':
-            self.audio_profile = media_info['@audioProfile']
-        self.audio_channels = media_info['@audioChannels']
-        self.video_resolution = (int(media_info['@height']), int(media_info['@width']))
-        self.size = int(media_info['Part']['@size'])
-        self.duration = int(media_info['@duration'])
+            self.audio_profile = media['audioProfile']
+        self.audio_channels = media['audioChannels']
+        self.video_resolution = (int(media['height']), int(media['width']))
+        self.size = int(part['size'])
+        self.duration = int(media['duration'])
         self.bitrate = int(self.size * 8 / self.duration)
-        self.framerate = media_info['@videoFrameRate']
-        self.container = media_info['@container']
+        self.framerate = media['videoFrameRate']
+        self.container = media['container']
         self.get_reasons()
 
 
 class Library:
     def __init__(self, xml):
-        self.name = xml["@title"]
-        self.id = int(xml['Location']['@id'])
+        self.name = xml.get('title')
+        self.type = xml.get('type')
+        self.key = int(xml.get('key'))
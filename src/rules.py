@@ -0,0 +1,187 @@
+"""
+Target profile of the library and the cheapest action bringing an item to it.
+An item's reasons are the ways it differs from the profile. Every action fixes a set of reasons at an estimated
+cost in hours of work per hour of media, and the cheapest action fixing all of them is planned. Encodes cost more
+the more pixels per second the source has and the harder its codec is to decode.
+Resolution alone is never a reason: smaller videos are kept as they are and encodes only ever scale down.
+"""
+import re
+
+import numpy as np
+
+# Reasons fixed by each action, an encode converting the audio and remuxing as well
+ACTIONS = {'remux': {'Container'},
+           'audio': {'Container', 'Audio codec', 'Audio channels'},
+           'encode': {'Container', 'Audio codec', 'Audio channels', 'Video codec', 'High bitrate', 'Framerate'}}
+# Source the encode cost is given for (1080p at 24 fps), and bitrate of the converted audio track (kbps)
+REFERENCE_PIXEL_RATE = 1920 * 1080 * 24
+AUDIO_BITRATE = 128
+
+
+def frame_rate(value):
+    """
+    Frames per second of a Plex (24p, NTSC, PAL) or ffprobe (24) frame rate, 0 if unknown.
+    """
+    if value == 'NTSC':
+        return 30
+    if value == 'PAL':
+        return 25
+    match = re.match(r'\d+', str(value or ''))
+    return int(match.group()) if match else 0
+
+
+def channel_count(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def by_value(values, function):
+    """
+    Applies function once per distinct value of an array and spreads the results back over it.
+    """
+    uniques, inverse = np.unique(values, return_inverse=True)
+    return np.array([function(value) for value in uniques])[inverse.reshape(-1)]
+
+
+def config_set(value):
+    return {entry.strip().lower() for entry in value.split(',') if entry.strip()}
+
+
+def config_factors(value):
+    """
+    Parses a comma separated list of key: factor entries.
+    """
+    factors = {}
+    for entry in value.split(','):
+        if entry.strip():
+            key, factor = entry.split(':')
+            factors[key.strip().lower()] = float(factor)
+    return factors
+
+
+class Plan:
+    __slots__ = ('action', 'reasons', 'cost', 'size', 'max_framerate')
+
+    def __init__(self, action, reasons, cost, size, max_framerate=None):
+        self.action = action
+        self.reasons = reasons
+        self.cost = cost
+        self.size = size
+        self.max_framerate = max_framerate
+
+    def __repr__(self):
+        return f'<Plan: {self.action}, {self.cost:.2f}h, {self.size / 1e9:.2f}GB>'
+
+
+class TargetProfile:
+    def __init__(self, config, max_bitrate, average_bitrate):
+        self.video_codecs = config_set(config['VIDEO_CODECS'])
+        self.h264_profiles = config_set(config['H264_PROFILES'])
+        self.audio_codecs = config_set(config['AUDIO_CODECS'])
+        self.aac_profiles = config_set(config['AAC_PROFILES'])
+        self.max_audio_channels = config.getint('MAX_AUDIO_CHANNELS')
+        self.max_framerate = config.getint('MAX_FRAMERATE')
+        self.containers = config_set(config['CONTAINERS'])
+        self.costs = {action: config.getfloat(f'{action.upper()}_COST') for action in ACTIONS}
+        self.decode_costs = config_factors(config['DECODE_COSTS'])
+        self.max_bitrate = max_bitrate
+        self.target_bitrate = average_bitrate + AUDIO_BITRATE
+
+    def video_compliant(self, codec, profile):
+        return codec in self.video_codecs and (codec != 'h264' or profile in self.h264_profiles)
+
+    def audio_compliant(self, codec, profile, channels):
+        """
+        Whether an audio stream can be copied as it is, profile and channels as given by ffprobe or Plex.
+        """
+        return codec in self.audio_codecs and (codec != 'aac' or (profile or '').lower() in self.aac_profiles) and \
+            0 < channel_count(channels) <= self.max_audio_channels
+
+    def reasons(self, item):
+        reasons = {}
+        if not self.video_compliant(item.video_codec, item.video_profile):
+            reasons['Video codec'] = {'Codec': item.video_codec,
+                                      'Profile': item.video_profile}
+
+        if item.audio_codec not in self.audio_codecs:
+            reasons['Audio codec'] = item.audio_codec
+        elif item.audio_codec == 'aac' and item.audio_profile not in self.aac_profiles:
+            reasons['Audio codec'] = {'Codec': item.audio_codec,
+                                      'Profile': item.audio_profile}
+
+        if not 0 < channel_count(item.audio_channels) <= self.max_audio_channels:
+            reasons['Audio channels'] = item.audio_channels
+
+        if item.bitrate > self.max_bitrate:
+            reasons['High bitrate'] = {'Bitrate': item.bitrate,
+                                       'Resolution': item.video_resolution}
+
+        if item.container not in self.containers:
+            reasons['Container'] = item.container
+
+        if frame_rate(item.framerate) > self.max_framerate:
+            reasons['Framerate'] = item.framerate
+        return reasons
+
+    def needs_work(self, media, parts):
+        """
+        Vectorized reasons over many Plex media and their parts (attribute dicts, one row each).
+        Returns a boolean array telling which rows have any reason, as reasons() would on their RemoteItem.
+        """
+        if not media:
+            return np.zeros(0, dtype=bool)
+
+        def column(rows, key, default=''):
+            return np.array([row.get(key) or default for row in rows], dtype=str)
+
+        video_codec = column(media, 'videoCodec')
+        audio_codec = column(media, 'audioCodec')
+        size = column(parts, 'size', '0').astype(np.int64)
+        duration = column(media, 'duration', '0').astype(np.int64)
+
+        video_ok = np.isin(video_codec, list(self.video_codecs)) & \
+            ((video_codec != 'h264') | np.isin(column(media, 'videoProfile'), list(self.h264_profiles)))
+        audio_ok = np.isin(audio_codec, list(self.audio_codecs)) & \
+            ((audio_codec != 'aac') | np.isin(column(media, 'audioProfile'), list(self.aac_profiles)))
+        channels = by_value(column(media, 'audioChannels'), channel_count)
+        bitrate = np.floor_divide(size * 8, duration, out=np.zeros_like(size), where=duration > 0)
+        container_ok = np.isin(column(media, 'container'), list(self.containers))
+        framerate = by_value(column(media, 'videoFrameRate'), frame_rate)
+
+        return ~(video_ok & audio_ok & (channels > 0) & (channels <= self.max_audio_channels) &
+                 (bitrate <= self.max_bitrate) & container_ok & (framerate <= self.max_framerate))
+
+    def expected_size(self, item, action):
+        """
+        Estimated output size (bytes): the target bitrate for an encode, the source size otherwise.
+        """
+        if action == 'encode':
+            return min(item.duration / 1000 * self.target_bitrate * 1000 / 8, item.size or float('inf'))
+        return item.size
+
+    def cost(self, item, action):
+        """
+        Estimated hours of work of action on item, an encode scaling with the pixels per second of the source
+        (24 fps when unknown) and the decode cost of its codec.
+        """
+        hours = item.duration / 3600000 * self.costs[action]
+        if action != 'encode':
+            return hours
+        height, width = item.video_resolution
+        pixel_rate = height * width * (frame_rate(item.framerate) or 24)
+        return hours * pixel_rate / REFERENCE_PIXEL_RATE * self.decode_costs.get(item.video_codec, 1)
+
+    def plan(self, item):
+        """
+        Returns the plan of the cheapest action fixing every reason of item, None when it has none.
+        """
+        reasons = self.reasons(item)
+        if not reasons:
+            return None
+
+        action = min((action for action, fixed in ACTIONS.items() if fixed.issuperset(reasons)),
+                     key=lambda action: self.cost(item, action))
+        return Plan(action, reasons, self.cost(item, action), self.expected_size(item, action),
+                    self.max_framerate if 'Framerate' in reasons else None)
@@ -0,0 +1,114 @@
+"""
+Orders the downloads of the fetcher across every library and decides when the pipeline can take one more.
+"""
+import os
+import shutil
+import time
+
+
+class DownloadScheduler:
+    """
+    Global priority queue of pending remote items, ranked by estimated benefit per hour of work.
+    Benefit is the space the planned action is expected to save plus a weight per reason, work is the
+    estimated transfer time and cost of the action, and waiting items slowly gain priority so that none of
+    them starves.
+    """
+
+    def __init__(self, config):
+        self.saved_gb_weight = config.getfloat('SAVED_GB')
+        self.reason_weights = {key: config.getfloat(key) for key in
+                               ('VIDEO_CODEC', 'AUDIO_CODEC', 'AUDIO_CHANNELS', 'HIGH_BITRATE',
+                                'CONTAINER', 'FRAMERATE')}
+        self.transfer_cost = config.getfloat('TRANSFER_COST')
+        self.aging = config.getfloat('AGING')
+        self.pending = {}
+
+    def __len__(self):
+        return len(self.pending)
+
+    def update(self, items):
+        """
+        Replaces the pending items, keeping the waiting time of the ones already known.
+        """
+        now = time.time()
+        self.pending = {item.remote_path: (item, self.pending.get(item.remote_path, (None, now))[1])
+                        for item in items}
+
+    def score(self, item, first_seen, now):
+        saved_gb = max(item.size - item.plan.size, 0) / 1e9
+        benefit = saved_gb * self.saved_gb_weight + \
+            sum(self.reason_weights.get(reason.upper().replace(' ', '_'), 0) for reason in item.reasons)
+
+        work = item.plan.cost + item.size / 1e9 * self.transfer_cost
+        return benefit / max(work, 0.01) + self.aging * (now - first_seen) / 3600
+
+    def pop(self, admits=None):
+        """
+        Removes and returns the best ranked item admitted by admits, None if there is none.
+        """
+        now = time.time()
+        for key in sorted(self.pending, key=lambda k: self.score(*self.pending[k], now), reverse=True):
+            if admits is None or admits(self.pending[key][0]):
+                return self.pending.pop(key)[0]
+        return None
+
+
+class AdmissionControl:
+    """
+    Admits a download while the pipeline can take it: the files in the pipeline folders, the expected
+    output of the items still queued (as planned when they were downloaded) and the download with its own
+    output must fit in the disk budget and the free space, and the planned work of the queued items must stay
+    under a target number of hours at the converter's recent speed.
+    """
+
+    def __init__(self, config, folders, temp_folder, index):
+        self.disk_budget = config.getfloat('DISK_BUDGET_GB') * 1e9
+        self.reserve = config.getfloat('FREE_SPACE_RESERVE_GB') * 1e9
+        self.target_hours = config.getfloat('TARGET_QUEUE_HOURS')
+        self.default_speed = config.getfloat('DEFAULT_SPEED')
+        self.folders = folders
+        self.temp_folder = temp_folder
+        self.index = index
+
+    def bytes_in_flight(self):
+        total = 0
+        for folder in self.folders:
+            for root, _, files in os.walk(folder):
+                for file in files:
+                    try:
+                        total += os.path.getsize(os.path.join(root, file))
+                    except FileNotFoundError:
+                        pass
+        return total
+
+    def queued_items(self):
+        """
+        Hours of work and expected output sizes of the downloaded items not converted yet that are still in
+        the pipeline (their .info exists).
+        """
+        return [(cost, expected_size) for remote_path, cost, expected_size in self.index.queued()
+                if os.path.exists(os.path.join(self.temp_folder,
+                                               f'{os.path.basename(remote_path).rsplit(".", 1)[0]}.info'))]
+
+    def check(self, downloading=()):
+        """
+        Measures the pipeline once and returns a function telling whether an item can be downloaded,
+        items being downloaded are counted with their full size.
+        An item larger than the disk budget by itself is only admitted when the pipeline is empty, so that it
+        is not blocked forever nor downloaded next to other items.
+        """
+        queued = self.queued_items() + [(item.plan.cost, item.plan.size) for item in downloading]
+        in_flight = self.bytes_in_flight() + sum(expected_size for _, expected_size in queued) + \
+            sum(item.size for item in downloading)
+        free = shutil.disk_usage(self.temp_folder).free - self.reserve - sum(item.size for item in downloading)
+        speed = self.index.encode_speed() or self.default_speed
+        # Costs are hours of work at one second of media per second, scaled to the measured speed
+        queue_hours = sum(cost for cost, _ in queued) / speed
+
+        def admits(item):
+            needed = item.size + item.plan.size
+            if needed > free:
+                return False
+            return (in_flight + needed <= self.disk_budget or not in_flight) and queue_hours < self.target_hours
+
+        return admits
@@ -7,7 +7,8 @@ from subprocess import check_call, CalledProcessError
 
 from requests import get
 
-from modules import escape, get_pending_items, get_new_items, scp_option
+from modules import escape, get_pending_items, get_new_items, watcher
+from transfer import make_transfer
 
 
 class Subtitler:
@@ -39,6 +40,7 @@ class Subtitler:
         self.upload_after = config['SUBTITLER'].getboolean('UPLOAD_AFTER')
         self.upload_ssh = f'{config["SUBTITLER"]["USER"]}@{config["SUBTITLER"]["URL"]}'
         self.upload_dir = config['SUBTITLER']['DIRECTORY']
+        self.transfer = make_transfer(config['TRANSFER'], self.upload_ssh)
 
         self.last_path = ''
 
@@ -253,25 +255,11 @@ class Subtitler:
             f.write(os.path.join(self.library_directory, self.last_path, item.local_file))
         local_file = os.path.join(self.SUBBED_FOLDER, item.local_file)
 
-        command_info = f'scp {scp_option} ' \
-                       f'"{info_file}" ' \
-                       f'{self.upload_ssh}:\'\"{os.path.join(self.upload_dir, self.TEMP_FOLDER)}\"\''
+        self.transfer.upload(info_file, os.path.join(self.upload_dir, self.TEMP_FOLDER, os.path.basename(info_file)))
+        self.transfer.upload(local_file, os.path.join(self.upload_dir, self.CONVERTING_FOLDER, item.local_file))
 
-        command_file = f'scp {scp_option} ' \
-                       f'"{local_file}" ' \
-                       f'{self.upload_ssh}:\'\"{os.path.join(self.upload_dir, self.CONVERTING_FOLDER)}\"\''
-
-        try:
-            check_call(shlex.split(command_info))
-            check_call(shlex.split(command_file))
-
-            os.remove(local_file)
-            os.remove(info_file)
-
-        except CalledProcessError:
-            print('Upload failed !')
-            time.sleep(30)
-            self.upload(item)
+        os.remove(local_file)
+        os.remove(info_file)
 
     def prepare_for_conversion(self, item):
         os.rename(os.path.join(self.SUBBED_FOLDER, item.local_file),
@@ -282,13 +270,16 @@ class Subtitler:
 
         while True:
             for item in get_pending_items(self.SUBBED_FOLDER):
-                self.upload(item)
+                try:
+                    self.upload(item)
+                except IOError as e:
+                    print(f'{e}, keeping {item.local_file} for the next round')
 
             get_new_items(self.INPUT_FOLDER, items)
             if not items:
                 print('\nWaiting for new files...')
             while not items:
-                time.sleep(1)
+                watcher.wait()
                 get_new_items(self.INPUT_FOLDER, items)
 
             print('\nPlease select next file to process:')
@@ -0,0 +1,228 @@
+"""
+File transfers between this machine and a remote host.
+Downloads resume from what is already on disk, uploads go to a partial file renamed once it matches the
+source, and both give up after a few attempts. A transfer is skipped when the destination already holds the
+same file, compared by size and a hash of sampled blocks.
+"""
+import hashlib
+import os
+import platform
+import shlex
+import shutil
+import threading
+import time
+from subprocess import check_call, check_output, CalledProcessError
+
+scp_option = '-T' if platform.system() == 'Linux' else ''
+
+PARTIAL_SUFFIX = '.part'
+
+SAMPLE_BLOCK_SIZE = 65536
+SAMPLE_BLOCKS = 16
+
+
+def sample_blocks(size):
+    blocks = max((size + SAMPLE_BLOCK_SIZE - 1) // SAMPLE_BLOCK_SIZE, 1)
+    return sorted({i * (blocks - 1) // (SAMPLE_BLOCKS - 1) for i in range(SAMPLE_BLOCKS)})
+
+
+def fingerprint(path, blocks):
+    """
+    Returns (size, md5 of the given blocks) of a local file, None if it does not exist.
+    """
+    if not os.path.isfile(path):
+        return None
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in blocks:
+            f.seek(block * SAMPLE_BLOCK_SIZE)
+            digest.update(f.read(SAMPLE_BLOCK_SIZE))
+    return os.path.getsize(path), digest.hexdigest()
+
+
+class Transfer:
+    """
+    Base transfer, backends implement fetch, send and the remote file operations.
+    At most parallel transfers run at once in a process.
+    """
+
+    def __init__(self, ssh, parallel, bandwidth_limit, retry_delay=30, attempts=5):
+        self.ssh = ssh
+        self.bandwidth_limit = bandwidth_limit
+        self.retry_delay = retry_delay
+        self.attempts = attempts
+        self.slots = threading.BoundedSemaphore(parallel)
+
+    @staticmethod
+    def remote(path):
+        # Paths under the home directory are given relative to it, quoting would prevent expanding ~
+        return path[2:] if path.startswith('~/') else path
+
+    def ssh_call(self, *args):
+        return check_output(['ssh', self.ssh, *[shlex.quote(self.remote(arg)) for arg in args]])
+
+    def fetch(self, remote_path, local_path):
+        raise NotImplementedError
+
+    def send(self, local_path, remote_path):
+        raise NotImplementedError
+
+    def remote_size(self, remote_path):
+        return int(self.ssh_call('wc', '-c', remote_path).split()[0])
+
+    def makedirs(self, remote_dir):
+        self.ssh_call('mkdir', '-p', remote_dir)
+
+    def rename(self, remote_src, remote_dst):
+        self.ssh_call('mv', '-f', remote_src, remote_dst)
+
+    def remove(self, remote_path):
+        self.ssh_call('rm', '-f', remote_path)
+
+    def remote_fingerprint(self, remote_path, blocks):
+        """
+        Same as fingerprint for a remote file, computed by the remote shell in a single ssh round trip.
+        """
+        script = f'f={shlex.quote(self.remote(remote_path))}; [ -f "$f" ] || exit 0; wc -c < "$f"; ' \
+                 f'for b in {" ".join(map(str, blocks))}; do ' \
+                 f'dd if="$f" bs={SAMPLE_BLOCK_SIZE} skip=$b count=1 2>/dev/null; done | md5sum'
+        output = check_output(['ssh', self.ssh, script]).split()
+        if not output:
+            return None
+        return int(output[0]), output[1].decode()
+
+    def same_file(self, local_path, remote_path):
+        if not os.path.isfile(local_path):
+            return False
+        blocks = sample_blocks(os.path.getsize(local_path))
+        try:
+            return self.remote_fingerprint(remote_path, blocks) == fingerprint(local_path, blocks)
+        except (CalledProcessError, OSError, ValueError, IndexError):
+            return False
+
+    def download(self, remote_path, local_path, size=None):
+        if self.same_file(local_path, remote_path):
+            print(f'{os.path.basename(local_path)} already downloaded, skipping')
+            return
+
+        with self.slots:
+            for attempt in range(self.attempts):
+                if attempt:
+                    time.sleep(self.retry_delay)
+                try:
+                    self.fetch(remote_path, local_path)
+                    # The expected size may be stale, the file on the server having changed since
+                    local_size = os.path.getsize(local_path)
+                    if size is None or local_size == size or local_size == self.remote_size(remote_path):
+                        return
+                    print(f'Downloaded size of {os.path.basename(local_path)} does not match, resuming...')
+                except (CalledProcessError, OSError, ValueError) as e:
+                    print(f'Download failed ({e}), retry soon...')
+        raise IOError(f'Could not download {remote_path} in {self.attempts} attempts')
+
+    def upload(self, local_path, remote_path):
+        if self.same_file(local_path, remote_path):
+            print(f'{os.path.basename(remote_path)} already uploaded, skipping')
+            return
+
+        part_path = remote_path + PARTIAL_SUFFIX
+        blocks = sample_blocks(os.path.getsize(local_path))
+        with self.slots:
+            for attempt in range(self.attempts):
+                if attempt:
+                    time.sleep(self.retry_delay)
+                try:
+                    self.makedirs(os.path.dirname(remote_path))
+                    self.send(local_path, part_path)
+                    if self.remote_fingerprint(part_path, blocks) == fingerprint(local_path, blocks):
+                        self.rename(part_path, remote_path)
+                        return
+                    print(f'Uploaded {os.path.basename(local_path)} does not match, resuming...')
+                except (CalledProcessError, OSError, ValueError, IndexError) as e:
+                    print(f'Upload failed ({e}), retry soon...')
+        raise IOError(f'Could not upload {remote_path} in {self.attempts} attempts')
+
+
+class RsyncTransfer(Transfer):
+    """
+    rsync over ssh, partial files are kept and completed in place on the next attempt.
+    """
+
+    def rsync(self, source, destination):
+        command = ['rsync', '--partial', '--inplace', '--protect-args', '--times', '-e', 'ssh']
+        if self.bandwidth_limit:
+            command.append(f'--bwlimit={self.bandwidth_limit}')
+        check_call(command + [source, destination])
+
+    def fetch(self, remote_path, local_path):
+        self.rsync(f'{self.ssh}:{self.remote(remote_path)}', local_path)
+
+    def send(self, local_path, remote_path):
+        self.rsync(local_path, f'{self.ssh}:{self.remote(remote_path)}')
+
+
+class ScpTransfer(Transfer):
+    """
+    Plain scp, interrupted transfers start over.
+    """
+
+    def scp(self, source, destination):
+        command = ['scp', scp_option]
+        if self.bandwidth_limit:
+            command += ['-l', str(self.bandwidth_limit * 8)]
+        check_call([arg for arg in command if arg] + [source, destination])
+
+    def fetch(self, remote_path, local_path):
+        self.scp(f'{self.ssh}:{shlex.quote(self.remote(remote_path))}', local_path)
+
+    def send(self, local_path, remote_path):
+        self.scp(local_path, f'{self.ssh}:{shlex.quote(self.remote(remote_path))}')
+
+
+class LocalTransfer(Transfer):
+    """
+    Filesystem copy, for a library mounted on this machine. Interrupted copies are appended to.
+    The bandwidth limit does not apply.
+    """
+
+    @staticmethod
+    def copy(source, destination):
+        done = os.path.getsize(destination) if os.path.exists(destination) else 0
+        if done > os.path.getsize(source):
+            done = 0
+        with open(source, 'rb') as src, open(destination, 'r+b' if done else 'wb') as dst:
+            src.seek(done)
+            dst.seek(done)
+            dst.truncate()
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+
+    def fetch(self, remote_path, local_path):
+        self.copy(os.path.expanduser(remote_path), local_path)
+
+    def send(self, local_path, remote_path):
+        self.copy(local_path, os.path.expanduser(remote_path))
+
+    def remote_size(self, remote_path):
+        return os.path.getsize(os.path.expanduser(remote_path))
+
+    def remote_fingerprint(self, remote_path, blocks):
+        return fingerprint(os.path.expanduser(remote_path), blocks)
+
+    def makedirs(self, remote_dir):
+        os.makedirs(os.path.expanduser(remote_dir), exist_ok=True)
+
+    def rename(self, remote_src, remote_dst):
+        os.replace(os.path.expanduser(remote_src), os.path.expanduser(remote_dst))
+
+    def remove(self, remote_path):
+        try:
+            os.remove(os.path.expanduser(remote_path))
+        except FileNotFoundError:
+            pass
+
+
+BACKENDS = {'rsync': RsyncTransfer, 'scp': ScpTransfer, 'local': LocalTransfer}
+
+
+def make_transfer(config, ssh):
+    return BACKENDS[config['BACKEND']](ssh, config.getint('PARALLEL'), config.getint('BANDWIDTH_LIMIT'))
@@ -0,0 +1,169 @@
+"""
+Watches the pipeline folders and tells which files are ready to be processed.
+A file is ready once it has been closed after being written or moved in (inotify), or once its size and
+mtime stayed the same for a stability window (files found on startup, or polling when inotify is missing).
+"""
+import os
+import select
+import threading
+import time
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+
+class FileState:
+    __slots__ = ('signature', 'since', 'ready', 'by_event')
+
+    def __init__(self, signature, ready=False, by_event=False):
+        self.signature = signature
+        self.since = time.monotonic()
+        self.ready = ready
+        self.by_event = by_event
+
+
+class FolderWatcher:
+    MASK = 0 if INotify is None else (flags.CLOSE_WRITE | flags.MOVED_TO | flags.MOVED_FROM |
+                                      flags.CREATE | flags.MODIFY | flags.DELETE)
+
+    def __init__(self, stable_seconds, poll_interval):
+        self.stable_seconds = stable_seconds
+        self.poll_interval = poll_interval
+        self.folders = {}
+        self.watches = {}
+        self.woken = threading.Event()
+
+        self.inotify = None
+        if INotify is not None:
+            try:
+                self.inotify = INotify()
+                self.wake_read, self.wake_write = os.pipe()
+            except OSError as e:
+                print(f'inotify unavailable ({e}), polling folders instead')
+
+    @staticmethod
+    def signature(path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def watch(self, folder):
+        folder = os.path.abspath(folder)
+        if folder not in self.folders:
+            self.folders[folder] = {}
+            if self.inotify is not None:
+                self.watches[self.inotify.add_watch(folder, self.MASK)] = folder
+            self.resync(folder)
+        return folder
+
+    def resync(self, folder):
+        states = self.folders[folder]
+        files = set(os.listdir(folder))
+        for file in [file for file in states if file not in files]:
+            del states[file]
+        for file in files:
+            signature = self.signature(os.path.join(folder, file))
+            state = states.get(file)
+            if state is None or (state.signature != signature and not state.by_event):
+                states[file] = FileState(signature)
+
+    def handle_events(self, events):
+        """
+        Updates the file states, returns whether an event may have made a file ready or gone.
+        """
+        changed = False
+        for event in events:
+            if event.mask & flags.Q_OVERFLOW:
+                for folder in self.folders:
+                    self.resync(folder)
+                changed = True
+                continue
+
+            folder = self.watches.get(event.wd)
+            if folder is None or not event.name:
+                continue
+            states = self.folders[folder]
+
+            if event.mask & (flags.DELETE | flags.MOVED_FROM):
+                states.pop(event.name, None)
+                changed = True
+            elif event.mask & (flags.CLOSE_WRITE | flags.MOVED_TO):
+                states[event.name] = FileState(self.signature(os.path.join(folder, event.name)),
+                                               ready=True, by_event=True)
+                changed = True
+            elif event.mask & (flags.CREATE | flags.MODIFY):
+                state = states.get(event.name)
+                if state is None or state.ready or not state.by_event:
+                    states[event.name] = FileState(None, by_event=True)
+        return changed
+
+    def check_stability(self, folder):
+        now = time.monotonic()
+        for file, state in self.folders[folder].items():
+            if not (state.ready or state.by_event):
+                signature = self.signature(os.path.join(folder, file))
+                if signature != state.signature:
+                    state.signature, state.since = signature, now
+                elif now - state.since >= self.stable_seconds:
+                    state.ready = True
+
+    def ready(self, folder):
+        """
+        Returns the sorted names of the files of folder ready to be processed.
+        """
+        folder = self.watch(folder)
+        if self.inotify is None:
+            self.resync(folder)
+        else:
+            self.handle_events(self.inotify.read(timeout=0))
+        self.check_stability(folder)
+
+        return sorted(file for file, state in self.folders[folder].items() if state.ready)
+
+    def next_deadline(self):
+        deadlines = [state.since + self.stable_seconds
+                     for states in self.folders.values() for state in states.values()
+                     if not (state.ready or state.by_event)]
+        return min(deadlines) if deadlines else None
+
+    def wake(self):
+        """
+        Makes the current or next wait return, can be called from any thread.
+        """
+        if self.inotify is None:
+            self.woken.set()
+        else:
+            os.write(self.wake_write, b'\0')
+
+    def wait(self, timeout=None):
+        """
+        Blocks until a file is closed after writing, moved or deleted in a watched folder, a file may become
+        stable, wake is called, or timeout seconds. Writes in progress only update the file states.
+        """
+        if self.inotify is None:
+            if self.woken.wait(self.poll_interval if timeout is None else min(timeout, self.poll_interval)):
+                self.woken.clear()
+            return
+
+        end = None if timeout is None else time.monotonic() + timeout
+        while True:
+            for folder in self.folders:
+                self.check_stability(folder)
+            now = time.monotonic()
+            remaining = None if end is None else max(end - now, 0)
+            deadline = self.next_deadline()
+            if deadline is not None:
+                remaining = max(deadline - now, 0) if remaining is None else min(remaining, max(deadline - now, 0))
+
+            readable, _, _ = select.select([self.inotify, self.wake_read], [], [], remaining)
+            if not readable:
+                return
+            if self.wake_read in readable:
+                os.read(self.wake_read, 4096)
+                return
+            if self.handle_events(self.inotify.read(timeout=0)):
+                return
@@ -0,0 +1,63 @@
+"""
+Small HTTP listener receiving Plex webhooks, so that new media is fetched as soon as Plex adds it
+instead of at the next library scan.
+Plex posts multipart/form-data with the event as JSON in the payload field, a plain JSON body is accepted too.
+"""
+import json
+import threading
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def parse_payload(content_type, body):
+    if content_type.startswith('multipart/'):
+        message = BytesParser().parsebytes(f'Content-Type: {content_type}\r\n\r\n'.encode() + body)
+        if not message.is_multipart():
+            return None
+        for part in message.get_payload():
+            if part.get_param('name', header='content-disposition') == 'payload':
+                return json.loads(part.get_payload(decode=True))
+        return None
+    return json.loads(body)
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            payload = parse_payload(self.headers.get('Content-Type', ''), body)
+        except (ValueError, TypeError):
+            payload = None
+        self.send_response(400 if not isinstance(payload, dict) else 200)
+        self.end_headers()
+
+        if isinstance(payload, dict) and payload.get('event') == 'library.new':
+            metadata = payload.get('Metadata')
+            if not isinstance(metadata, dict):
+                metadata = {}
+            try:
+                section = int(metadata['librarySectionID'])
+            except (KeyError, TypeError, ValueError):
+                section = None
+            print(f'Plex added {metadata.get("title", "new media")}')
+            self.server.on_new(section)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class WebhookListener:
+    """
+    Serves webhooks on port in a background thread, on_new is called with the library section id
+    (None if unknown) of every library.new event.
+    """
+
+    def __init__(self, port, on_new):
+        self.server = ThreadingHTTPServer(('', port), WebhookHandler)
+        self.server.daemon_threads = True
+        self.server.on_new = on_new
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        print(f'Listening for Plex webhooks on port {self.server.server_address[1]}')